@@ -0,0 +1,333 @@
+import json
+import random
+from urllib.parse import parse_qsl
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi
+from flask import abort
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+
+from cache import seenItemsStore
+from flaskr import create_app
+from helpers import app_item_args, items_count_query, items_list_args, \
+    items_list_data, items_list_query, items_page_query, needs_items_count, \
+    split_page
+from migrations import check_schema
+from models import Category, Item, engine_options, \
+    set_transactions_timeout, unseen_item_statements
+from serialization import dumps_compact
+
+"""
+asynchronous serving mode of the REST API
+
+    the read endpoints are served by async handlers running their queries
+    through async SQLAlchemy, so that many requests can wait on the
+    database concurrently within one process; the other requests are
+    handed over to the Flask app' in a thread; the arguments validation and
+    the statements of the handlers are shared with the Flask views
+
+    run it with `uvicorn asgi:create_asgi_app --factory --port 5000`
+"""
+
+ERROR_MESSAGES = {
+    400: "bad request, please check your input params...",
+    404: "resource not found, aborting...",
+    422: "could not process your request, aborting...",
+    500: "server error, please try again later..."
+}
+
+
+"""
+async_database_path(database_path)
+    the URL of the async driver of a database
+"""
+
+
+def async_database_path(database_path):
+    for syncScheme, asyncScheme in [
+        ("postgresql://", "postgresql+asyncpg://"),
+        ("postgresql+psycopg2://", "postgresql+asyncpg://"),
+        ("sqlite://", "sqlite+aiosqlite://")
+    ]:
+        if database_path.startswith(syncScheme):
+            return asyncScheme + database_path[len(syncScheme):]
+    return database_path
+
+
+"""
+async_engine_options(config, database_path)
+    the engine options of the app' for the async engine, with the connect
+    arguments of asyncpg instead of psycopg2's; behind an external pooler
+    asyncpg must not cache prepared statements, as the pooler may run them
+    on another server connection, and the statement timeout is set by each
+    transaction instead
+"""
+
+
+def async_engine_options(config, database_path):
+    options = engine_options(config, database_path)
+    if not database_path.startswith("postgresql"):
+        return options
+    options.pop("connect_args", None)
+    if config.get("DB_EXTERNAL_POOLER"):
+        options["connect_args"] = {"statement_cache_size": 0}
+    elif config.get("DB_STATEMENT_TIMEOUT") is not None:
+        options["connect_args"] = {
+            "server_settings": {
+                "statement_timeout": str(config["DB_STATEMENT_TIMEOUT"])
+            }
+        }
+    return options
+
+
+"""
+AsyncApi
+    ASGI app' serving the read endpoints asynchronously, with the same
+    JSON envelope as the Flask app'
+"""
+
+
+class AsyncApi:
+
+    def __init__(self, flaskApp):
+        self.flaskApp = flaskApp
+        self.config = flaskApp.config
+        self.wsgiApp = WsgiToAsgi(flaskApp)
+        databasePath = self.config["SQLALCHEMY_DATABASE_URI"]
+        self.engine = create_async_engine(
+            async_database_path(databasePath),
+            **async_engine_options(self.config, databasePath)
+        )
+        if self.config.get("DB_EXTERNAL_POOLER") and \
+                self.config.get("DB_STATEMENT_TIMEOUT") is not None and \
+                databasePath.startswith("postgresql"):
+            set_transactions_timeout(
+                self.engine.sync_engine,
+                self.config["DB_STATEMENT_TIMEOUT"]
+            )
+        self.routes = {
+            ("GET", "/api"): self.get_base_url,
+            ("GET", "/api/categories"): self.get_categories,
+            ("GET", "/api/items"): self.get_items,
+            ("POST", "/api/stuff"): self.get_app_item
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        handler = None
+        if scope["type"] == "http":
+            handler = self.routes.get((scope["method"], scope["path"]))
+        if handler is None:
+            return await self.wsgiApp(scope, receive, send)
+        try:
+            status, payload = await handler(scope, receive)
+        except HTTPException as e:
+            status, payload = e.code, None
+        except Exception:
+            self.flaskApp.logger.exception(
+                "error while handling %s %s",
+                scope["method"],
+                scope["path"]
+            )
+            status, payload = 500, None
+        if payload is None:
+            payload = {
+                "msg": ERROR_MESSAGES.get(status, ERROR_MESSAGES[500]),
+                "success": False,
+                "data": None
+            }
+        await self.sendJson(send, status, payload)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.connect()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # opens a first connection before serving, as concurrent first
+    # connections of a fresh pool can block each other
+    async def connect(self):
+        async with self.engine.connect():
+            pass
+
+    async def sendJson(self, send, status, payload):
+        # same output as Flask's `jsonify` outside of debug mode
+        body = dumps_compact(payload) + b"\n"
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"access-control-allow-origin", b"*"),
+                (
+                    b"access-control-allow-headers",
+                    b"Content-Type,Authorization,true,X-DB-Primary-Until"
+                ),
+                (
+                    b"access-control-allow-methods",
+                    b"GET,PATCH,POST,DELETE,OPTIONS"
+                )
+            ]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def readJson(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get("body", b'')
+            if not message.get("more_body", False):
+                break
+        try:
+            return json.loads(body)
+        except ValueError:
+            abort(400)
+
+    async def fetchCategories(self, connection):
+        result = await connection.execute(
+            select(Category.id, Category.type).order_by(Category.id)
+        )
+        return [{"id": row[0], "type": row[1]} for row in result]
+
+    async def get_base_url(self, scope, receive):
+        return 200, {
+            "msg": "REST API is up",
+            "success": True,
+            "data": None
+        }
+
+    async def get_categories(self, scope, receive):
+        async with self.engine.connect() as connection:
+            formattedCategs = await self.fetchCategories(connection)
+        if len(formattedCategs) == 0:
+            abort(404)
+        return 200, {
+            "msg": "fetched categories",
+            "success": True,
+            "data": {
+                "categories": formattedCategs,
+                "totalCategs": len(formattedCategs)
+            }
+        }
+
+    async def get_items(self, scope, receive):
+        listArgs = items_list_args(MultiDict(parse_qsl(
+            scope["query_string"].decode(),
+            keep_blank_values=True
+        )))
+        batchSize = self.config["ITEMS_BATCH_SIZE"]
+        async with self.engine.connect() as connection:
+            formattedCategs = None
+            categId = None
+            if listArgs["includesCategories"] or listArgs["categ"] != '':
+                formattedCategs = await self.fetchCategories(connection)
+            if listArgs["categ"] != '':
+                categIds = [
+                    categ["id"] for categ in formattedCategs
+                    if categ["type"] == listArgs["categ"]
+                ]
+                if len(categIds) == 0:
+                    abort(404)
+                categId = categIds[0]
+            itemsQuery = items_list_query(
+                listArgs,
+                categId,
+                self.engine.dialect.name
+            )
+            paginatedItems, hasMore = split_page(
+                (await connection.execute(
+                    items_page_query(itemsQuery, listArgs, batchSize)
+                )).all(),
+                batchSize
+            )
+            if len(paginatedItems) == 0:
+                abort(404)
+            totalItems = None
+            if needs_items_count(listArgs, hasMore):
+                totalItems = (await connection.execute(
+                    items_count_query(itemsQuery)
+                )).scalar()
+        data = items_list_data(
+            listArgs,
+            batchSize,
+            paginatedItems,
+            hasMore,
+            totalItems
+        )
+        if listArgs["includesCategories"]:
+            data["categories"] = formattedCategs
+        return 200, {
+            "msg": "fetched items",
+            "success": True,
+            "data": data
+        }
+
+    # the sessions store may be Redis, which client blocks, so it is called
+    # in a thread to keep the event loop serving
+    async def get_app_item(self, scope, receive):
+        appItemArgs = app_item_args(await self.readJson(receive))
+        usesSession = appItemArgs["usesSession"]
+        seenIds = appItemArgs["prevItems"]
+        sessionToken = appItemArgs["sessionToken"]
+        if usesSession:
+            if sessionToken is None:
+                sessionToken = seenItemsStore.newToken()
+            else:
+                seenIds |= await sync_to_async(
+                    seenItemsStore.getSeen,
+                    thread_sensitive=False
+                )(sessionToken)
+        async with self.engine.connect() as connection:
+            categId = None
+            if appItemArgs["category"] != "all":
+                categId = (await connection.execute(
+                    select(Category.id).where(
+                        Category.type == appItemArgs["category"]
+                    )
+                )).scalar()
+                if categId is None:
+                    abort(404)
+            boundsQuery, probeQueries = unseen_item_statements(
+                categId,
+                seenIds,
+                self.engine.dialect.name
+            )
+            minId, maxId = (await connection.execute(boundsQuery)).one()
+            if minId is None:
+                abort(400)
+            item = None
+            for probeQuery in probeQueries(random.randint(minId, maxId)):
+                item = (await connection.execute(probeQuery)).first()
+                if item is not None:
+                    break
+        if item is None:
+            abort(400)
+        formattedItem = Item.formatRow(item)
+        if usesSession:
+            await sync_to_async(
+                seenItemsStore.addSeen,
+                thread_sensitive=False
+            )(sessionToken, item[0])
+            formattedItem["sessionToken"] = sessionToken
+        return 200, {
+            "msg": "app item fetched",
+            "success": True,
+            "data": formattedItem
+        }
+
+
+def create_asgi_app(test_config=None):
+    flaskApp = create_app(test_config)
+    if test_config is None and flaskApp.config["DB_CHECK_SCHEMA"]:
+        check_schema(flaskApp)
+    return AsyncApi(flaskApp)
@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+from asgi import create_asgi_app
+from benchmarks.common import summarize
+
+"""
+compares the sync (Flask) and async (ASGI) serving modes of the API by
+sending the same GET requests to both apps in process, with the same
+number of requests in flight, and prints the results as JSON
+
+    python -m benchmarks.async_vs_sync --url "/api/items?page=2"
+"""
+
+
+def run_sync(flaskApp, url, requests, concurrency):
+    clients = threading.local()
+
+    def send(i):
+        if not hasattr(clients, "client"):
+            clients.client = flaskApp.test_client()
+        startedAt = time.perf_counter()
+        res = clients.client.get(url)
+        res.get_data()
+        return time.perf_counter() - startedAt, res.status_code
+
+    startedAt = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(requests)))
+    return results, time.perf_counter() - startedAt
+
+
+async def send_async(asgiApp, path, queryString):
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": queryString.encode(),
+        "headers": []
+    }
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": b'', "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    startedAt = time.perf_counter()
+    await asgiApp(scope, receive, send)
+    return time.perf_counter() - startedAt, status
+
+
+async def run_async(asgiApp, url, requests, concurrency):
+    splitUrl = urlsplit(url)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(i):
+        async with semaphore:
+            return await send_async(asgiApp, splitUrl.path, splitUrl.query)
+
+    # warms the pool up, as the server does on startup
+    await asgiApp.connect()
+    await asyncio.gather(*[send(i) for i in range(concurrency)])
+    startedAt = time.perf_counter()
+    results = await asyncio.gather(*[send(i) for i in range(requests)])
+    elapsed = time.perf_counter() - startedAt
+    await asgiApp.engine.dispose()
+    return results, elapsed
+
+
+def report(results, elapsed):
+    summary = summarize([latency for latency, status in results], elapsed)
+    summary["errors"] = len(
+        [status for latency, status in results if status >= 500]
+    )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="/api/items")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asgiApp = create_asgi_app()
+    # warms the sync pool up so that connections are pooled
+    run_sync(asgiApp.flaskApp, args.url, args.concurrency, args.concurrency)
+    syncResults = run_sync(
+        asgiApp.flaskApp,
+        args.url,
+        args.requests,
+        args.concurrency
+    )
+    asyncResults = asyncio.run(
+        run_async(asgiApp, args.url, args.requests, args.concurrency)
+    )
+    print(json.dumps({
+        "url": args.url,
+        "concurrency": args.concurrency,
+        "sync": report(*syncResults),
+        "async": report(*asyncResults)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
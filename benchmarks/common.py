@@ -0,0 +1,51 @@
+import math
+import random
+
+"""
+summarize(latencies, elapsed)
+    latency percentiles, in milliseconds, and throughput of a benchmark
+    run made of requests which latencies are in seconds
+"""
+
+
+def percentile(sortedValues, rank):
+    if len(sortedValues) == 0:
+        return None
+    index = max(0, math.ceil(rank / 100 * len(sortedValues)) - 1)
+    return sortedValues[index]
+
+
+def summarize(latencies, elapsed):
+    sortedLatencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "elapsedS": round(elapsed, 3),
+        "throughputRps": round(len(latencies) / elapsed, 1),
+        "p50Ms": round(percentile(sortedLatencies, 50) * 1000, 3),
+        "p95Ms": round(percentile(sortedLatencies, 95) * 1000, 3),
+        "p99Ms": round(percentile(sortedLatencies, 99) * 1000, 3)
+    }
+
+
+"""
+benchmark dataset
+
+    the categories and items seeded by `benchmarks.seed` are named with
+    these prefixes, so that they can be told apart from the other data;
+    the items titles are made of words of a fixed vocabulary, which the
+    search scenarios look for
+"""
+
+CATEG_PREFIX = "bench categ "
+ITEM_PREFIX = "bench item "
+
+
+def vocabulary(size=256):
+    rng = random.Random(0)
+    words = set()
+    while len(words) < size:
+        words.add("".join(
+            rng.choice("bcdfghjklmnprstvz") + rng.choice("aeiou")
+            for _ in range(3)
+        ))
+    return sorted(words)
@@ -0,0 +1,332 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from urllib.parse import quote
+
+from sqlalchemy import func, select
+
+from benchmarks.common import CATEG_PREFIX, ITEM_PREFIX, summarize, \
+    vocabulary
+from cache import responseCache
+from flaskr import create_app
+from models import Category, Item, db
+
+"""
+runs repeatable scenarios against the API in process, on the data seeded
+by `benchmarks.seed`, and prints their latency percentiles, throughput
+and SQL statements per request as JSON; the requests of each scenario
+are drawn from a seeded random generator, so that two runs on the same
+data send the same requests; the response cache is off unless a backend
+is given, so that the scenarios measure the queries of the API
+
+    python -m benchmarks.scenarios --requests 500 > results.json
+    python -m benchmarks.scenarios --baseline results.json
+"""
+
+QUERIES_COUNT = re.compile(r'desc="(\d+) queries"')
+
+
+def load_dataset(app):
+    with app.app_context():
+        categories = db.session.execute(
+            select(Category.id, Category.type).where(
+                Category.type.startswith(CATEG_PREFIX)
+            ).order_by(Category.id)
+        ).all()
+        itemsCount, minId, maxId = db.session.execute(
+            select(func.count(Item.id), func.min(Item.id), func.max(Item.id))
+        ).one()
+        dialect = db.engine.dialect.name
+        db.session.close()
+    return {
+        "dialect": dialect,
+        "categories": [
+            {"id": categ.id, "type": categ.type} for categ in categories
+        ],
+        "items": itemsCount,
+        "minId": minId,
+        "maxId": maxId,
+        "pageSize": app.config["ITEMS_BATCH_SIZE"]
+    }
+
+
+"""
+scenarios
+
+    each scenario builds the requests it sends, as (method, url, payload)
+    tuples, from a random generator and the dataset; the write scenarios
+    leave the data as they found it
+"""
+
+
+def pages_count(dataset):
+    return max(1, math.ceil(dataset["items"] / dataset["pageSize"]))
+
+
+def items_paging(client, rng, dataset, count):
+    return [
+        ("GET", "/api/items?page={}".format(
+            rng.randint(1, min(10, pages_count(dataset)))
+        ), None)
+        for _ in range(count)
+    ]
+
+
+def items_deep_pages(client, rng, dataset, count):
+    pagesCount = pages_count(dataset)
+    return [
+        ("GET", "/api/items?page={}".format(
+            rng.randint(max(1, pagesCount * 9 // 10), pagesCount)
+        ), None)
+        for _ in range(count)
+    ]
+
+
+def items_deep_keyset(client, rng, dataset, count):
+    lastIds = range(
+        dataset["minId"] + (dataset["maxId"] - dataset["minId"]) * 9 // 10,
+        dataset["maxId"]
+    )
+    return [
+        ("GET", "/api/items?after_id={}".format(rng.choice(lastIds)), None)
+        for _ in range(count)
+    ]
+
+
+def items_categ(client, rng, dataset, count):
+    return [
+        ("GET", "/api/items?categ={}".format(
+            quote(rng.choice(dataset["categories"])["type"])
+        ), None)
+        for _ in range(count)
+    ]
+
+
+def items_search(client, rng, dataset, count):
+    words = vocabulary()
+    return [
+        ("GET", "/api/items?searchTerm={}".format(rng.choice(words)), None)
+        for _ in range(count)
+    ]
+
+
+def stuff_prev_items(prevItemsCount):
+    def build(client, rng, dataset, count):
+        ids = range(dataset["minId"], dataset["maxId"] + 1)
+        # half of the items at most, so that there are some left to pick
+        sampleSize = min(prevItemsCount, len(ids) // 2)
+        return [
+            ("POST", "/api/stuff", {
+                "category": "all",
+                "prevItems": rng.sample(ids, sampleSize)
+            })
+            for _ in range(count)
+        ]
+    return build
+
+
+def create_item(client, rng, dataset, count):
+    runId = secrets.token_hex(4)
+    return [
+        ("POST", "/api/items", {
+            "item": "{}created {} {}".format(ITEM_PREFIX, runId, i),
+            "category": rng.choice(dataset["categories"])["id"]
+        })
+        for i in range(count)
+    ]
+
+
+def delete_created_items(client, responses):
+    ids = [
+        response["data"]["id"] for response in responses
+        if response is not None and response.get("data") is not None
+    ]
+    if len(ids) > 0:
+        client.delete("/api/items", json={"ids": ids})
+
+
+# the items to delete are created beforehand, in bulk
+def delete_item(client, rng, dataset, count):
+    runId = secrets.token_hex(4)
+    res = client.post("/api/items/bulk", json=[
+        {
+            "item": "{}deleted {} {}".format(ITEM_PREFIX, runId, i),
+            "category": rng.choice(dataset["categories"])["id"]
+        }
+        for i in range(count)
+    ])
+    return [
+        ("DELETE", "/api/items/{}".format(result["id"]), None)
+        for result in res.json["data"]["results"]
+        if result["status"] == "created"
+    ]
+
+
+SCENARIOS = {
+    "items_paging": (items_paging, None),
+    "items_deep_pages": (items_deep_pages, None),
+    "items_deep_keyset": (items_deep_keyset, None),
+    "items_categ": (items_categ, None),
+    "items_search": (items_search, None),
+    "stuff_prev_items_0": (stuff_prev_items(0), None),
+    "stuff_prev_items_10": (stuff_prev_items(10), None),
+    "stuff_prev_items_100": (stuff_prev_items(100), None),
+    "stuff_prev_items_1000": (stuff_prev_items(1000), None),
+    "create_item": (create_item, delete_created_items),
+    "delete_item": (delete_item, None)
+}
+
+
+def run_requests(app, requests, concurrency):
+    clients = threading.local()
+
+    def send(request):
+        if not hasattr(clients, "client"):
+            clients.client = app.test_client()
+        method, url, payload = request
+        startedAt = time.perf_counter()
+        res = clients.client.open(url, method=method, json=payload)
+        res.get_data()
+        latency = time.perf_counter() - startedAt
+        queries = QUERIES_COUNT.search(res.headers.get("Server-Timing", ""))
+        return {
+            "latency": latency,
+            "status": res.status_code,
+            "queries": int(queries.group(1)) if queries else None,
+            "json": res.json if res.is_json else None
+        }
+
+    startedAt = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, requests))
+    return results, time.perf_counter() - startedAt
+
+
+def report(results, elapsed):
+    summary = summarize([result["latency"] for result in results], elapsed)
+    queries = [
+        result["queries"] for result in results
+        if result["queries"] is not None
+    ]
+    summary["errors"] = len(
+        [result for result in results if result["status"] >= 400]
+    )
+    summary["queriesPerRequest"] = round(sum(queries) / len(queries), 2) \
+        if len(queries) > 0 else None
+    summary["maxQueriesPerRequest"] = max(queries, default=None)
+    return summary
+
+
+def run_scenario(app, name, rng, dataset, requestsCount, concurrency):
+    buildRequests, cleanup = SCENARIOS[name]
+    client = app.test_client()
+    requests = buildRequests(client, rng, dataset, requestsCount)
+    results, elapsed = run_requests(app, requests, concurrency)
+    if cleanup is not None:
+        cleanup(client, [result["json"] for result in results])
+    return report(results, elapsed)
+
+
+"""
+compare(scenarios, baselineScenarios, tolerance)
+    the scenarios which p95 latency grew by more than `tolerance`, or
+    which run more SQL statements per request, than in a baseline run
+"""
+
+
+def compare(scenarios, baselineScenarios, tolerance):
+    regressions = []
+    for name, summary in scenarios.items():
+        baseline = baselineScenarios.get(name)
+        if baseline is None:
+            continue
+        summary["baseline"] = {
+            key: baseline[key]
+            for key in ["p50Ms", "p95Ms", "p99Ms", "throughputRps",
+                        "queriesPerRequest"]
+        }
+        if summary["p95Ms"] > baseline["p95Ms"] * (1 + tolerance) or \
+                (summary["queriesPerRequest"] or 0) > \
+                (baseline["queriesPerRequest"] or 0):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="scenario to run, all of them by default"
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="JSON report of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--response-cache",
+        choices=["memory", "redis"],
+        help="response cache backend, off by default"
+    )
+    args = parser.parse_args()
+    app = create_app()
+    # whatever the `.env` file of the app' says
+    app.config["RESPONSE_CACHE_BACKEND"] = args.response_cache or ""
+    responseCache.init_app(app)
+    # the SQL statements of each request are counted in this header
+    app.config["SERVER_TIMING"] = True
+    dataset = load_dataset(app)
+    if len(dataset["categories"]) == 0:
+        sys.exit("no benchmark data, please run `python -m benchmarks.seed`")
+    # warms the pool and the caches of the app' up
+    run_requests(app, [("GET", "/api/items", None)] * args.concurrency,
+                 args.concurrency)
+    scenarios = {}
+    for name in args.scenario or list(SCENARIOS):
+        scenarios[name] = run_scenario(
+            app,
+            name,
+            random.Random("{}:{}".format(args.seed, name)),
+            dataset,
+            args.requests,
+            args.concurrency
+        )
+    output = {
+        "dataset": {
+            "dialect": dataset["dialect"],
+            "items": dataset["items"],
+            "categories": len(dataset["categories"]),
+            "pageSize": dataset["pageSize"]
+        },
+        "settings": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "responseCache": app.config["RESPONSE_CACHE_BACKEND"] or None
+        },
+        "scenarios": scenarios
+    }
+    if args.baseline is not None:
+        with open(args.baseline) as baselineFile:
+            baselineScenarios = json.load(baselineFile)["scenarios"]
+        output["regressions"] = compare(
+            scenarios,
+            baselineScenarios,
+            args.tolerance
+        )
+    print(json.dumps(output, indent=2))
+    if len(output.get("regressions", [])) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import io
+import itertools
+import json
+import random
+import time
+
+from sqlalchemy import select, text
+
+from benchmarks.common import CATEG_PREFIX, ITEM_PREFIX, vocabulary
+from flaskr import create_app
+from migrations import upgrade
+from models import Category, Item, db
+
+"""
+seeds the database of the app' with benchmark categories and items, which
+replace the ones of a previous run, and prints how long it took as JSON;
+the items are loaded with `COPY` on PostgreSQL and with batched inserts
+elsewhere, and the same seed always gives the same data
+
+    python -m benchmarks.seed --items 1000000 --categories 100
+"""
+
+
+def delete_bench_data(connection):
+    benchCategIds = select(Category.id).where(
+        Category.type.startswith(CATEG_PREFIX)
+    ).scalar_subquery()
+    connection.execute(
+        Item.__table__.delete().where(Item.category.in_(benchCategIds))
+    )
+    connection.execute(
+        Category.__table__.delete().where(
+            Category.type.startswith(CATEG_PREFIX)
+        )
+    )
+
+
+def insert_categories(connection, categoriesCount):
+    connection.execute(Category.__table__.insert(), [
+        {"type": CATEG_PREFIX + str(i)} for i in range(categoriesCount)
+    ])
+    return [row.id for row in connection.execute(
+        select(Category.id).where(
+            Category.type.startswith(CATEG_PREFIX)
+        ).order_by(Category.id)
+    )]
+
+
+"""
+generate_items(rng, categIds, itemsCount)
+    the title and category of each item; a few categories hold most of
+    the items, as in real catalogs
+"""
+
+
+def generate_items(rng, categIds, itemsCount):
+    words = vocabulary()
+    cumWeights = list(itertools.accumulate(
+        1 / (rank + 1) for rank in range(len(categIds))
+    ))
+    for i in range(itemsCount):
+        title = "{}{} {} {}".format(
+            ITEM_PREFIX,
+            i,
+            rng.choice(words),
+            rng.choice(words)
+        )
+        yield title, rng.choices(categIds, cum_weights=cumWeights)[0]
+
+
+def batches(rows, batchSize):
+    while True:
+        batch = list(itertools.islice(rows, batchSize))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+# the titles have no tabs, newlines or backslashes to escape
+def copy_items(connection, batch):
+    buffer = io.StringIO()
+    for title, categId in batch:
+        buffer.write("{}\t{}\n".format(title, categId))
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert("COPY items (item, category) FROM STDIN", buffer)
+    finally:
+        cursor.close()
+
+
+def insert_items(connection, batch):
+    connection.execute(Item.__table__.insert(), [
+        {"item": title, "category": categId} for title, categId in batch
+    ])
+
+
+def seed(engine, itemsCount, categoriesCount, batchSize, seedValue):
+    rng = random.Random(seedValue)
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # the loads outlast the DB_STATEMENT_TIMEOUT of the requests
+            connection.execute(text("SET LOCAL statement_timeout = 0"))
+        delete_bench_data(connection)
+        categIds = insert_categories(connection, categoriesCount)
+        if connection.dialect.name == "postgresql":
+            loadBatch = copy_items
+        else:
+            loadBatch = insert_items
+        for batch in batches(
+            generate_items(rng, categIds, itemsCount),
+            batchSize
+        ):
+            loadBatch(connection, batch)
+        if connection.dialect.name == "postgresql":
+            # fresh statistics, so that the planner knows the new volumes
+            connection.execute(text("ANALYZE categories"))
+            connection.execute(text("ANALYZE items"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=100000)
+    parser.add_argument("--categories", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    app = create_app()
+    with app.app_context():
+        upgrade(db.engine)
+        startedAt = time.perf_counter()
+        seed(db.engine, args.items, args.categories, args.batch_size,
+             args.seed)
+        elapsed = time.perf_counter() - startedAt
+    print(json.dumps({
+        "items": args.items,
+        "categories": args.categories,
+        "seed": args.seed,
+        "elapsedS": round(elapsed, 3),
+        "itemsPerSecond": round(args.items / elapsed, 1)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,526 @@
+from collections import OrderedDict
+import functools
+import hashlib
+import json
+import secrets
+import threading
+import time
+from urllib.parse import urlencode
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from metrics import Counter
+from models import Category, count_items_by_category, items_version, \
+    primary_reads, reads_replica
+
+cacheRequests = Counter(
+    "cache_requests_total",
+    "Number of cache lookups, by cache and result.",
+    ["cache", "result"]
+)
+
+"""
+CategoriesCache
+    process-local cache of the formatted categories list and of the
+    categories ids by type; it expires after a TTL and is invalidated
+    whenever a transaction that changed categories is committed; its
+    version is a hash of its content, so that workers holding the same
+    categories agree on it; it is loaded from the primary database, as a
+    lagging replica would keep it stale for a whole TTL
+"""
+
+
+class CategoriesCache:
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._loadedAt = None
+
+    def init_app(self, app):
+        self.ttl = app.config["CATEGORIES_CACHE_TTL"]
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._loadedAt = None
+
+    def _isFresh(self):
+        return self._snapshot is not None and \
+            time.monotonic() - self._loadedAt < self.ttl
+
+    def _load(self):
+        with self._lock:
+            if self._isFresh():
+                cacheRequests.inc("categories", "hit")
+                return self._snapshot
+            cacheRequests.inc("categories", "miss")
+            with primary_reads():
+                categories = Category.query.order_by(Category.id).all()
+            formattedCategs = [category.format() for category in categories]
+            self._snapshot = (
+                formattedCategs,
+                {categ["type"]: categ["id"] for categ in formattedCategs},
+                {categ["id"]: categ["type"] for categ in formattedCategs},
+                hashlib.md5(
+                    json.dumps(formattedCategs, sort_keys=True).encode()
+                ).hexdigest()
+            )
+            self._loadedAt = time.monotonic()
+            return self._snapshot
+
+    def getFormattedCategories(self):
+        return self._load()[0]
+
+    def getIdByType(self, categType):
+        return self._load()[1].get(categType)
+
+    def getTypeById(self, categId):
+        return self._load()[2].get(categId)
+
+    def getVersion(self):
+        return self._load()[3]
+
+
+categoriesCache = CategoriesCache()
+
+
+"""
+invalidation hooks
+    flag the sessions that write categories, then invalidate the cache
+    once their transaction is committed so that no other request can
+    cache uncommitted data
+"""
+
+
+def _flagCategoriesChange(session):
+    session.info["categoriesChanged"] = True
+
+
+@event.listens_for(Session, "after_flush")
+def _onFlush(session, flushContext):
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, Category):
+            _flagCategoriesChange(session)
+            return
+
+
+@event.listens_for(Session, "after_bulk_update")
+def _onBulkUpdate(updateContext):
+    if updateContext.mapper.class_ is Category:
+        _flagCategoriesChange(updateContext.session)
+
+
+@event.listens_for(Session, "after_bulk_delete")
+def _onBulkDelete(deleteContext):
+    if deleteContext.mapper.class_ is Category:
+        _flagCategoriesChange(deleteContext.session)
+
+
+@event.listens_for(Session, "after_commit")
+def _onCommit(session):
+    if session.info.pop("categoriesChanged", False):
+        categoriesCache.invalidate()
+        responseCache.invalidate("categories")
+
+
+@event.listens_for(Session, "after_rollback")
+def _onRollback(session):
+    session.info.pop("categoriesChanged", None)
+
+
+"""
+MemoryBackend
+    LRU store of the cached responses for tests and single node setups;
+    namespaces versions are kept apart so that they are never evicted
+"""
+
+
+class MemoryBackend:
+
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expiresAt = entry
+            if expiresAt < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def getVersions(self, names):
+        with self._lock:
+            return [self._versions.get(name, 0) for name in names]
+
+    def getSet(self, key):
+        value = self.get(key)
+        if value is None:
+            return set()
+        with self._lock:
+            return set(value)
+
+    def addToSet(self, key, member, ttl):
+        with self._lock:
+            entry = self._entries.get(key)
+            # the members of an expired set are not carried over
+            members = set() if entry is None or \
+                entry[1] < time.monotonic() else entry[0]
+            members.add(member)
+            self._entries[key] = (members, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def incr(self, name):
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+            return self._versions[name]
+
+
+"""
+RedisBackend
+    store shared by all the workers of a deployment, talking to any
+    server speaking the Redis protocol
+"""
+
+
+class RedisBackend:
+
+    def __init__(self, url):
+        # only needed by the deployments that share their cache
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=ttl)
+
+    def getVersions(self, names):
+        return [int(version or 0) for version in self.client.mget(names)]
+
+    def getSet(self, key):
+        return {int(member) for member in self.client.smembers(key)}
+
+    def addToSet(self, key, member, ttl):
+        pipeline = self.client.pipeline()
+        pipeline.sadd(key, member)
+        pipeline.expire(key, ttl)
+        pipeline.execute()
+
+    def incr(self, name):
+        return self.client.incr(name)
+
+
+"""
+ResponseCache
+    caches the JSON bodies of the read endpoints, keyed on their path,
+    their normalized query string and the versions of the namespaces
+    they depend on; bumping a namespace version invalidates its entries
+
+    the failures of its backend are logged and the requests go on
+    without the cache, e.g. while Redis is down
+
+    the requests which read from a replica don't store their responses
+    for the read-your-writes window after a write, as the replica may not
+    have replayed it yet while the namespaces versions are already bumped
+"""
+
+
+class ResponseCache:
+
+    def __init__(self):
+        self.backend = None
+        self.ttl = 30
+        self.replicaLag = 0
+
+    def init_app(self, app):
+        backendName = app.config["RESPONSE_CACHE_BACKEND"]
+        self.ttl = app.config["RESPONSE_CACHE_TTL"]
+        self.replicaLag = app.config["READ_YOUR_WRITES_WINDOW"] \
+            if app.config.get("REPLICA_BINDS") else 0
+        if backendName == "memory":
+            self.backend = MemoryBackend(app.config["RESPONSE_CACHE_SIZE"])
+        elif backendName == "redis":
+            self.backend = RedisBackend(app.config["RESPONSE_CACHE_URL"])
+        else:
+            self.backend = None
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def getVersions(self, *namespaces):
+        return self.backend.getVersions(
+            ["version:" + namespace for namespace in namespaces]
+        )
+
+    def logBackendError(self, action):
+        current_app.logger.warning(
+            "response cache %s failed", action, exc_info=True
+        )
+
+    # the data version of a conditional request is part of its key, so that
+    # no worker serves a body older than the version in its ETag; None when
+    # the backend fails
+    def keyFor(self, namespaces):
+        try:
+            versions = self.getVersions(*namespaces)
+        except Exception:
+            self.logBackendError("lookup")
+            return None
+        return "response:" + ".".join(str(v) for v in versions) + ":" + \
+            g.get("dataVersion", "") + ":" + normalized_url()
+
+    def get(self, key):
+        try:
+            return self.backend.get(key)
+        except Exception:
+            self.logBackendError("lookup")
+            return None
+
+    def set(self, key, body):
+        try:
+            self.backend.set(key, body, self.ttl)
+        except Exception:
+            self.logBackendError("store")
+
+    # the entries of a failed invalidation expire after the TTL, and the
+    # conditional requests still see the new items version
+    def invalidate(self, *namespaces):
+        if not self.enabled:
+            return
+        try:
+            for namespace in namespaces:
+                self.backend.incr("version:" + namespace)
+            if self.replicaLag > 0:
+                self.backend.set("recentWrite", b"1", self.replicaLag)
+        except Exception:
+            self.logBackendError("invalidation")
+
+    def storesResponse(self):
+        if self.replicaLag <= 0 or not reads_replica():
+            return True
+        try:
+            return self.backend.get("recentWrite") is None
+        except Exception:
+            self.logBackendError("lookup")
+            return False
+
+    def invalidateItems(self, *categIds):
+        if not self.enabled:
+            return
+        namespaces = ["items:all"]
+        for categId in categIds:
+            categType = categoriesCache.getTypeById(categId)
+            if categType is not None:
+                namespaces.append(items_namespace(categType))
+        self.invalidate(*namespaces)
+
+
+responseCache = ResponseCache()
+
+
+def normalized_url():
+    queryString = urlencode(sorted(
+        (arg, value)
+        for arg, values in request.args.lists()
+        for value in values
+    ))
+    return request.path + "?" + queryString
+
+
+def items_namespace(categType):
+    if categType == '':
+        return "items:all"
+    return "items:categ:" + categType
+
+
+"""
+cached_response(namespacesFn)
+    serves a view from the response cache when it is enabled and
+    available; only successful responses are cached
+"""
+
+
+def cached_response(namespacesFn):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not responseCache.enabled:
+                return view(*args, **kwargs)
+            key = responseCache.keyFor(namespacesFn())
+            if key is None:
+                return view(*args, **kwargs)
+            body = responseCache.get(key)
+            cacheRequests.inc("response", "miss" if body is None else "hit")
+            if body is not None:
+                # its compressed bodies are cached under the same key
+                g.responseCacheKey = key
+                return current_app.response_class(
+                    body,
+                    status=200,
+                    mimetype="application/json"
+                )
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and \
+                    responseCache.storesResponse():
+                responseCache.set(key, response.get_data())
+                g.responseCacheKey = key
+            return response
+        return wrapper
+    return decorator
+
+
+"""
+DataVersion
+    cheap version of the data served by the read endpoints, made of the
+    items version maintained by the database, read once per request, and
+    of the version of the categories served by the current worker
+"""
+
+
+class DataVersion:
+
+    def recordItemsWrite(self, *categIds):
+        responseCache.invalidateItems(*categIds)
+
+    def itemsVersion(self):
+        if not has_request_context():
+            return items_version()
+        if "itemsVersion" not in g:
+            g.itemsVersion = items_version()
+        return g.itemsVersion
+
+    def items(self):
+        return "{}.{}".format(
+            self.itemsVersion(),
+            categoriesCache.getVersion()
+        )
+
+    def categories(self):
+        return categoriesCache.getVersion()
+
+
+dataVersion = DataVersion()
+
+
+"""
+ItemCountsCache
+    process-local cache of the number of items of each category, reloaded
+    from the primary database when the items version changes, or after a
+    TTL
+"""
+
+
+class ItemCountsCache:
+
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._counts = None
+        self._version = None
+        self._loadedAt = None
+
+    def init_app(self, app):
+        self.ttl = app.config["ITEM_COUNTS_CACHE_TTL"]
+        with self._lock:
+            self._counts = None
+
+    def getItemCounts(self):
+        version = dataVersion.itemsVersion()
+        with self._lock:
+            if self._counts is None or self._version != version or \
+                    time.monotonic() - self._loadedAt >= self.ttl:
+                cacheRequests.inc("itemCounts", "miss")
+                with primary_reads():
+                    self._counts = count_items_by_category()
+                self._version = version
+                self._loadedAt = time.monotonic()
+            else:
+                cacheRequests.inc("itemCounts", "hit")
+            return self._counts
+
+
+itemCountsCache = ItemCountsCache()
+
+
+"""
+conditional_response(versionFn)
+    answers `304 Not Modified` without running a view when the client
+    already has the current version of its response, and sets a weak
+    ETag on the responses of the view otherwise
+"""
+
+
+def conditional_response(versionFn):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.dataVersion = versionFn()
+            etag = hashlib.md5(
+                (g.dataVersion + ":" + normalized_url()).encode()
+            ).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag, weak=True)
+                return response
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag, weak=True)
+            return response
+        return wrapper
+    return decorator
+
+
+"""
+SeenItemsStore
+    server side sets of the items already served by /api/stuff, keyed on
+    session tokens, so that clients don't have to send their whole history;
+    the sets are shared by the workers when the response cache uses Redis
+"""
+
+
+class SeenItemsStore:
+
+    def __init__(self):
+        self.backend = MemoryBackend()
+        self.ttl = 3600
+
+    def init_app(self, app):
+        self.ttl = app.config["SEEN_ITEMS_TTL"]
+        if isinstance(responseCache.backend, RedisBackend):
+            self.backend = responseCache.backend
+        else:
+            self.backend = MemoryBackend(app.config["SEEN_ITEMS_SESSIONS"])
+
+    def newToken(self):
+        return secrets.token_urlsafe(16)
+
+    def getSeen(self, token):
+        return self.backend.getSet("seen:" + token)
+
+    def addSeen(self, token, itemId):
+        self.backend.addToSet("seen:" + token, itemId, self.ttl)
+
+
+seenItemsStore = SeenItemsStore()
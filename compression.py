@@ -0,0 +1,134 @@
+import zlib
+
+from flask import g, request
+
+from cache import cacheRequests, responseCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+response compression
+
+    the responses are compressed with the best encoding accepted by their
+    client, brotli then gzip; small bodies are sent as they are, as their
+    compressed size would barely differ
+"""
+
+COMPRESSIBLE_MIMETYPES = ["application/json", "application/x-ndjson"]
+
+
+def available_encodings():
+    if brotli is None:
+        return ["gzip"]
+    return ["br", "gzip"]
+
+
+"""
+negotiate_encoding()
+    the encoding to use for the current request, None if its client
+    doesn't accept any of the available ones
+"""
+
+
+def negotiate_encoding():
+    bestEncoding = None
+    bestQuality = 0
+    for encoding in available_encodings():
+        quality = request.accept_encodings.quality(encoding)
+        if quality > bestQuality:
+            bestEncoding = encoding
+            bestQuality = quality
+    return bestEncoding
+
+
+"""
+new_compressor(encoding, config)
+    the functions that compress a chunk, flush the data compressed so far
+    and end a compressed stream
+"""
+
+
+def new_compressor(encoding, config):
+    if encoding == "br":
+        compressor = brotli.Compressor(
+            quality=config["COMPRESSION_BROTLI_QUALITY"]
+        )
+        return compressor.process, compressor.flush, compressor.finish
+    # gzip container, with no timestamp so that the output is stable
+    compressor = zlib.compressobj(
+        config["COMPRESSION_LEVEL"],
+        zlib.DEFLATED,
+        31
+    )
+    return compressor.compress, \
+        lambda: compressor.flush(zlib.Z_SYNC_FLUSH), \
+        compressor.flush
+
+
+def compress(body, encoding, config):
+    process, flush, finish = new_compressor(encoding, config)
+    return process(body) + finish()
+
+
+# each chunk is flushed so that streamed responses still go out as they are
+# written instead of when the compressor's buffers are full
+def compress_chunks(chunks, encoding, config):
+    process, flush, finish = new_compressor(encoding, config)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        compressedChunk = process(chunk) + flush()
+        if compressedChunk != b'':
+            yield compressedChunk
+    yield finish()
+
+
+"""
+compress_response(app, response)
+    compresses a response body for its client; the compressed bodies of
+    the cached responses are cached as well, so that they are compressed
+    once per encoding
+"""
+
+
+def compress_response(app, response):
+    if not app.config["COMPRESSION_ENABLED"] or \
+            response.status_code != 200 or \
+            response.direct_passthrough or \
+            "Content-Encoding" in response.headers or \
+            not (response.mimetype in COMPRESSIBLE_MIMETYPES or
+                 response.mimetype.startswith("text/")):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(
+            response.response,
+            encoding,
+            app.config
+        )
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < app.config["COMPRESSION_MIN_SIZE"]:
+            return response
+        cacheKey = g.get("responseCacheKey")
+        compressedBody = None
+        if cacheKey is not None:
+            compressedBody = responseCache.get(cacheKey + ":" + encoding)
+            cacheRequests.inc(
+                "compressedResponse",
+                "miss" if compressedBody is None else "hit"
+            )
+        if compressedBody is None:
+            compressedBody = compress(body, encoding, app.config)
+            if cacheKey is not None:
+                responseCache.set(cacheKey + ":" + encoding, compressedBody)
+        response.set_data(compressedBody)
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -1,41 +1,170 @@
 from dotenv import load_dotenv
-from flask import Flask, jsonify
+from flask import Flask, abort, jsonify, request
 from flask_cors import CORS
+import hmac
 import os
 from routes import init_routes
 
-from models import setup_db
+from cache import categoriesCache, itemCountsCache, responseCache, \
+    seenItemsStore
+
+from compression import compress_response
+
+from instrumentation import errors, record_request, slowQueryLog, \
+    start_request
+
+from metrics import metricsExporter
+
+from migrations import dbCli
+
+from models import PRIMARY_UNTIL_HEADER, mark_write, setup_db
+
+from serialization import FastJSONProvider
+
+
+def getIntEnv(name, default=None):
+    value = os.getenv(name)
+    if value is None or value == '':
+        return default
+    return int(value)
+
+
+def getFloatEnv(name, default=None):
+    value = os.getenv(name)
+    if value is None or value == '':
+        return default
+    return float(value)
+
+
+def getBoolEnv(name, default=False):
+    value = os.getenv(name)
+    if value is None or value == '':
+        return default
+    return value.lower() in ["1", "true", "yes"]
+
+
+def getListEnv(name):
+    return [value for value in os.getenv(name, "").split(",") if value != '']
+
 
 def create_app(test_config=None):
 
     # create and configure the app
     load_dotenv()
     app = Flask(__name__)
+    app.json = FastJSONProvider(app)
     itemsBatchSize = 10
     if os.getenv("ITEMS_BATCH_SIZE") is not None:
         itemsBatchSize = 10
     app.config["ITEMS_BATCH_SIZE"] = itemsBatchSize
+    app.config["CATEGORIES_CACHE_TTL"] = getIntEnv("CATEGORIES_CACHE_TTL", 60)
+    app.config["ITEM_COUNTS_CACHE_TTL"] = getIntEnv(
+        "ITEM_COUNTS_CACHE_TTL", 10
+    )
+    app.config["RESPONSE_CACHE_BACKEND"] = os.getenv(
+        "RESPONSE_CACHE_BACKEND", ""
+    )
+    app.config["RESPONSE_CACHE_URL"] = os.getenv("RESPONSE_CACHE_URL")
+    app.config["RESPONSE_CACHE_TTL"] = getIntEnv("RESPONSE_CACHE_TTL", 30)
+    app.config["RESPONSE_CACHE_SIZE"] = getIntEnv("RESPONSE_CACHE_SIZE", 1024)
+    app.config["CACHE_CONTROL"] = os.getenv("CACHE_CONTROL") or "no-cache"
+    app.config["SERVER_TIMING"] = getBoolEnv("SERVER_TIMING", True)
+    app.config["METRICS_ENABLED"] = getBoolEnv("METRICS_ENABLED", True)
+    app.config["METRICS_DIR"] = os.getenv("METRICS_DIR") or None
+    app.config["METRICS_FLUSH_INTERVAL"] = getFloatEnv(
+        "METRICS_FLUSH_INTERVAL", 1
+    )
+    app.config["SLOW_QUERY_THRESHOLD_MS"] = getIntEnv(
+        "SLOW_QUERY_THRESHOLD_MS"
+    )
+    app.config["SLOW_QUERY_EXPLAIN"] = getBoolEnv("SLOW_QUERY_EXPLAIN")
+    app.config["SLOW_QUERY_LOG_SIZE"] = getIntEnv("SLOW_QUERY_LOG_SIZE", 100)
+    app.config["ADMIN_TOKEN"] = os.getenv("ADMIN_TOKEN") or None
+    app.config["COMPRESSION_ENABLED"] = getBoolEnv(
+        "COMPRESSION_ENABLED", True
+    )
+    app.config["COMPRESSION_MIN_SIZE"] = getIntEnv(
+        "COMPRESSION_MIN_SIZE", 1024
+    )
+    app.config["COMPRESSION_LEVEL"] = getIntEnv("COMPRESSION_LEVEL", 6)
+    app.config["COMPRESSION_BROTLI_QUALITY"] = getIntEnv(
+        "COMPRESSION_BROTLI_QUALITY", 4
+    )
+    app.config["BULK_INSERT_BATCH_SIZE"] = getIntEnv(
+        "BULK_INSERT_BATCH_SIZE", 1000
+    )
+    app.config["BULK_DELETE_BATCH_SIZE"] = getIntEnv(
+        "BULK_DELETE_BATCH_SIZE", 1000
+    )
+    app.config["EXPORT_BATCH_SIZE"] = getIntEnv("EXPORT_BATCH_SIZE", 1000)
+    app.config["SEEN_ITEMS_TTL"] = getIntEnv("SEEN_ITEMS_TTL", 3600)
+    app.config["SEEN_ITEMS_SESSIONS"] = getIntEnv("SEEN_ITEMS_SESSIONS", 10000)
+    app.config["DB_POOL_SIZE"] = getIntEnv("DB_POOL_SIZE")
+    app.config["DB_MAX_OVERFLOW"] = getIntEnv("DB_MAX_OVERFLOW")
+    app.config["DB_POOL_TIMEOUT"] = getIntEnv("DB_POOL_TIMEOUT")
+    app.config["DB_POOL_RECYCLE"] = getIntEnv("DB_POOL_RECYCLE")
+    app.config["DB_POOL_PRE_PING"] = getBoolEnv("DB_POOL_PRE_PING")
+    app.config["DB_STATEMENT_TIMEOUT"] = getIntEnv("DB_STATEMENT_TIMEOUT")
+    app.config["DB_EXTERNAL_POOLER"] = getBoolEnv("DB_EXTERNAL_POOLER")
+    app.config["READ_YOUR_WRITES_WINDOW"] = getIntEnv(
+        "READ_YOUR_WRITES_WINDOW", 5
+    )
+    app.config["DB_CHECK_SCHEMA"] = getBoolEnv("DB_CHECK_SCHEMA")
     if test_config is None:
-        setup_db(app, os.getenv("DATABASE_PATH"))
+        setup_db(
+            app,
+            os.getenv("DATABASE_PATH"),
+            getListEnv("REPLICA_DATABASE_PATHS")
+        )
     elif test_config == "test":
-        setup_db(app, os.getenv("TEST_DATABASE_PATH"))
+        setup_db(
+            app,
+            os.getenv("TEST_DATABASE_PATH"),
+            getListEnv("TEST_REPLICA_DATABASE_PATHS")
+        )
+    # the schema is migrated with `flask db upgrade`, not on boot
+    app.cli.add_command(dbCli)
+
+    categoriesCache.init_app(app)
+    itemCountsCache.init_app(app)
+    responseCache.init_app(app)
+    seenItemsStore.init_app(app)
+    metricsExporter.init_app(app)
+    slowQueryLog.init_app(app)
 
-    cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
+    # cross-origin clients read the read-your-writes header of their writes
+    cors = CORS(app, resources={r"/api/*": {
+        "origins": "*",
+        "expose_headers": [PRIMARY_UNTIL_HEADER]
+    }})
+
+    @app.before_request
+    def before_request():
+        start_request()
 
     @app.after_request
     def after_request(response):
         response.headers.add(
             "Access-Control-Allow-Headers",
-            "Content-Type,Authorization,true"
+            "Content-Type,Authorization,true," + PRIMARY_UNTIL_HEADER
         )
         response.headers.add(
             "Access-Control-Allow-Methods",
             "GET,PATCH,POST,DELETE,OPTIONS"
         )
-        return response
+        if request.method in ["POST", "PATCH", "DELETE"] and \
+                response.status_code < 400:
+            mark_write(app, response)
+        # GET responses carry an ETag, so they can be revalidated cheaply
+        if request.method == "GET" and response.status_code in (200, 304) \
+                and "Cache-Control" not in response.headers:
+            response.headers["Cache-Control"] = app.config["CACHE_CONTROL"]
+        response = compress_response(app, response)
+        return record_request(app, response)
 
     @app.errorhandler(400)
     def bad_request(error):
+        errors.inc("400")
         return jsonify({
             "msg": "bad request, please check your input params...",
             "success": False,
@@ -44,6 +173,7 @@ def create_app(test_config=None):
 
     @app.errorhandler(404)
     def not_found(error):
+        errors.inc("404")
         return jsonify({
             "msg": "resource not found, aborting...",
             "success": False,
@@ -52,6 +182,7 @@ def create_app(test_config=None):
 
     @app.errorhandler(422)
     def unprocessable(error):
+        errors.inc("422")
         return jsonify({
             "msg": "could not process your request, aborting...",
             "success": False,
@@ -60,12 +191,44 @@ def create_app(test_config=None):
 
     @app.errorhandler(500)
     def unprocessable(error):
+        errors.inc("500")
         return jsonify({
             "msg": "server error, please try again later...",
             "success": False,
             "data": None
         }), 500
 
+    if app.config["METRICS_ENABLED"]:
+        @app.route("/metrics", methods=["GET"])
+        def get_metrics():
+            return app.response_class(
+                metricsExporter.render(),
+                status=200,
+                content_type="text/plain; version=0.0.4; charset=utf-8"
+            )
+
+    # admin endpoints require the `ADMIN_TOKEN` as a bearer token, they
+    # don't exist for the clients that don't have it
+    def check_admin_token():
+        adminToken = app.config["ADMIN_TOKEN"]
+        authorization = request.headers.get("Authorization", "")
+        if adminToken is None or not hmac.compare_digest(
+            authorization.encode(),
+            ("Bearer " + adminToken).encode()
+        ):
+            abort(404)
+
+    @app.route("/admin/slow-queries", methods=["GET"])
+    def get_slow_queries():
+        check_admin_token()
+        return jsonify({
+            "msg": "fetched slow queries",
+            "success": True,
+            "data": {
+                "slowQueries": slowQueryLog.getEntries()
+            }
+        }), 200
+
     init_routes(app)
 
     return app
@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+import random
+import shutil
+
+from dotenv import load_dotenv
+
+from flaskr import getIntEnv
+
+"""
+gunicorn settings of the REST API, tunable with the `GUNICORN_*` env vars
+of the environment or of the `.env` file; empty values are left unset
+"""
+
+# the app' loads it later on, once gunicorn is configured
+load_dotenv()
+
+bind = os.getenv("GUNICORN_BIND") or "0.0.0.0:5000"
+
+# the usual `2 x cores + 1` workers, as they mostly wait on the database
+workers = getIntEnv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1)
+# more than one thread per worker switches to the threaded workers; sync
+# workers are killed when a request, e.g. a streamed export, outlasts the
+# timeout, while the threaded ones keep notifying the master
+threads = getIntEnv("GUNICORN_THREADS", 1)
+worker_class = "gthread" if threads > 1 else "sync"
+
+# the app' is imported once by the master and shared copy-on-write
+preload_app = True
+
+# workers are replaced after some requests to cap their memory growth,
+# with some jitter so that they don't all restart at once
+max_requests = getIntEnv("GUNICORN_MAX_REQUESTS", 1000)
+max_requests_jitter = getIntEnv("GUNICORN_MAX_REQUESTS_JITTER", 100)
+timeout = getIntEnv("GUNICORN_TIMEOUT", 30)
+graceful_timeout = getIntEnv("GUNICORN_GRACEFUL_TIMEOUT", 30)
+keepalive = getIntEnv("GUNICORN_KEEPALIVE", 5)
+
+accesslog = "-"
+errorlog = "-"
+
+# the workers share their metrics through files, see `metrics.py`
+if not os.getenv("METRICS_DIR"):
+    os.environ["METRICS_DIR"] = "/tmp/rest-api-metrics"
+
+
+def on_starting(server):
+    # the metrics of a previous run must not be added to the new ones
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+
+
+def post_fork(server, worker):
+    from models import reset_after_fork
+    from wsgi import app
+    # database connections opened by the master can't be shared by workers
+    reset_after_fork(app)
+    # otherwise all the workers would pick the same "random" items
+    random.seed()
+
+
+def worker_exit(server, worker):
+    from metrics import metricsExporter
+    metricsExporter.flush()
+
+
+def child_exit(server, worker):
+    from metrics import metricsExporter
+    # keeps the counters of the exited worker without its snapshot
+    metricsExporter.foldDeadSnapshots()
@@ -1,5 +1,227 @@
-def paginate_items(itemsBatchSize, page, items):
-    start = (page - 1) * itemsBatchSize
-    end = start + itemsBatchSize
-    paginatedItems = items[start:end]
-    return paginatedItems
\ No newline at end of file
+import base64
+import binascii
+import csv
+import io
+import itertools
+from flask import abort
+from sqlalchemy import func
+
+from models import Item, rank_search_results, search_items
+from serialization import dumps_compact
+
+EXPORT_CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8"
+}
+
+
+"""
+items listing
+
+    the arguments validation and the statements of `GET /api/items`,
+    shared by the sync and async serving modes; invalid arguments abort
+    the request
+"""
+
+
+def is_ids_list(value):
+    return isinstance(value, list) and all(
+        isinstance(id, int) and not isinstance(id, bool) for id in value
+    )
+
+
+# returns the comma separated values of a query param, None if absent
+def get_list_arg(args, name, allowedValues):
+    valuesStr = args.get(name, None, type=str)
+    if valuesStr is None:
+        return None
+    values = [value for value in valuesStr.split(",") if value != '']
+    if any(value not in allowedValues for value in values):
+        abort(400)
+    return values
+
+
+# returns the id to page after in keyset mode, None otherwise
+def get_last_seen_id(args):
+    cursor = args.get("cursor", None, type=str)
+    if cursor is not None:
+        lastSeenId = decode_cursor(cursor)
+        if lastSeenId is None:
+            abort(400)
+        return lastSeenId
+    afterId = args.get("after_id", None, type=str)
+    if afterId is not None:
+        if not afterId.isdigit():
+            abort(400)
+        return int(afterId)
+    return None
+
+
+"""
+items_list_args(args)
+    the validated arguments of a listing, from the MultiDict of its query
+    string
+"""
+
+
+def items_list_args(args):
+    page = args.get("page", 1, type=int)
+    if page < 1:
+        abort(404)
+    # sparse responses only have the requested fields and embeddings
+    fields = get_list_arg(args, "fields", Item.FIELDS)
+    includes = get_list_arg(args, "include", ["categories"])
+    if fields == []:
+        abort(400)
+    if includes is None:
+        # full responses embed the categories for backward compatibility
+        includesCategories = fields is None
+    else:
+        includesCategories = "categories" in includes
+    searchTerm = args.get("searchTerm", '', type=str)
+    rankedResults = searchTerm != '' and \
+        args.get("sort", '', type=str) == "relevance"
+    lastSeenId = get_last_seen_id(args)
+    # keyset pages only follow the items ids order
+    if rankedResults and lastSeenId is not None:
+        abort(400)
+    return {
+        "categ": args.get("categ", '', type=str),
+        "fields": fields,
+        "includesCategories": includesCategories,
+        "lastSeenId": lastSeenId,
+        "page": page,
+        "rankedResults": rankedResults,
+        "searchTerm": searchTerm
+    }
+
+
+def items_list_query(listArgs, categId, dialectName):
+    itemsQuery = Item.selectRows(listArgs["fields"]).order_by(Item.id)
+    if categId is not None:
+        itemsQuery = itemsQuery.where(Item.category == categId)
+    itemsQuery = search_items(itemsQuery, listArgs["searchTerm"])
+    if listArgs["rankedResults"]:
+        itemsQuery = rank_search_results(
+            itemsQuery,
+            listArgs["searchTerm"],
+            dialectName
+        )
+    return itemsQuery
+
+
+# fetching one extra row tells whether there is a next page
+def items_page_query(itemsQuery, listArgs, itemsBatchSize):
+    if listArgs["lastSeenId"] is None:
+        return itemsQuery.limit(itemsBatchSize + 1).offset(
+            (listArgs["page"] - 1) * itemsBatchSize
+        )
+    return itemsQuery.where(
+        Item.id > listArgs["lastSeenId"]
+    ).limit(itemsBatchSize + 1)
+
+
+def split_page(rows, itemsBatchSize):
+    return rows[:itemsBatchSize], len(rows) > itemsBatchSize
+
+
+# keyset pages are meant to cost the same at any depth, so they have no
+# total, and on the last page the total is known without a COUNT
+def needs_items_count(listArgs, hasMore):
+    return listArgs["lastSeenId"] is None and hasMore
+
+
+def items_count_query(itemsQuery):
+    return itemsQuery.order_by(None).with_only_columns(func.count(Item.id))
+
+
+"""
+items_list_data(listArgs, itemsBatchSize, rows, hasMore, totalItems)
+    the data of a listing response, without its categories
+"""
+
+
+def items_list_data(listArgs, itemsBatchSize, rows, hasMore, totalItems):
+    if listArgs["lastSeenId"] is None and not hasMore:
+        totalItems = (listArgs["page"] - 1) * itemsBatchSize + len(rows)
+    nextCursor = None
+    if hasMore and not listArgs["rankedResults"]:
+        nextCursor = encode_cursor(rows[-1][0])
+    return {
+        "currentCategory": listArgs["categ"],
+        "items": Item.formatRows(rows, listArgs["fields"]),
+        "nextCursor": nextCursor,
+        "totalItems": totalItems
+    }
+
+
+"""
+app_item_args(payload)
+    the validated arguments of a `POST /api/stuff` request; clients using
+    a server side session don't need to send prevItems
+"""
+
+
+def app_item_args(payload):
+    if not isinstance(payload, dict) or \
+            not isinstance(payload.get("category"), str):
+        abort(400)
+    usesSession = "sessionToken" in payload
+    if not usesSession and "prevItems" not in payload:
+        abort(400)
+    prevItems = payload.get("prevItems", [])
+    if not is_ids_list(prevItems):
+        abort(400)
+    sessionToken = payload.get("sessionToken")
+    if sessionToken is not None and not isinstance(sessionToken, str):
+        abort(400)
+    return {
+        "category": payload["category"],
+        "prevItems": set(prevItems),
+        "sessionToken": sessionToken,
+        "usesSession": usesSession
+    }
+
+
+def encode_cursor(lastSeenId):
+    token = base64.urlsafe_b64encode(("id:" + str(lastSeenId)).encode())
+    return token.decode().rstrip("=")
+
+
+# returns the last seen id of a cursor, or None if it is invalid
+def decode_cursor(cursor):
+    try:
+        decoded = base64.urlsafe_b64decode(
+            cursor + "=" * (-len(cursor) % 4)
+        ).decode()
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    prefix, _, lastSeenId = decoded.partition(":")
+    if prefix != "id" or not lastSeenId.isdigit():
+        return None
+    return int(lastSeenId)
+
+
+# streams items rows as chunks of NDJSON or CSV, one chunk per batch
+def export_chunks(rows, exportFormat, batchSize):
+    rows = iter(rows)
+    if exportFormat == "csv":
+        yield b"id,item,category\r\n"
+    while True:
+        batch = list(itertools.islice(rows, batchSize))
+        if len(batch) == 0:
+            return
+        if exportFormat == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(
+                (row[0], row[1], row[2]) for row in batch
+            )
+            yield buffer.getvalue().encode()
+        else:
+            yield b"".join(
+                dumps_compact(
+                    {"category": row[2], "id": row[0], "item": row[1]},
+                    sortKeys=False
+                ) + b"\n"
+                for row in batch
+            )
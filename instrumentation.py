@@ -0,0 +1,293 @@
+import collections
+import datetime
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import DURATION_BUCKETS, Counter, Gauge, Histogram, \
+    metricsExporter
+from models import pool_stats
+
+"""
+request instrumentation
+
+    each request records its wall time, the number and the duration of
+    its SQL statements and its response size, in histograms by endpoint
+    and in a `Server-Timing` header; the statements run while a streamed
+    response is sent are not counted
+
+    along with the requests in flight, the error responses and the state
+    of the database connections pool, they are served by `/metrics`
+"""
+
+requestDuration = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling the requests.",
+    ["endpoint", "status"],
+    DURATION_BUCKETS
+)
+requestsInFlight = Gauge(
+    "http_requests_in_flight",
+    "Number of requests being handled.",
+    []
+)
+requestDbQueries = Histogram(
+    "http_request_db_queries",
+    "Number of SQL statements run by the requests.",
+    ["endpoint"],
+    [0, 1, 2, 3, 5, 10, 20, 50, 100]
+)
+requestDbDuration = Histogram(
+    "http_request_db_duration_seconds",
+    "Time spent running the SQL statements of the requests.",
+    ["endpoint"],
+    DURATION_BUCKETS
+)
+responseSize = Histogram(
+    "http_response_size_bytes",
+    "Size of the response bodies, streamed ones excluded.",
+    ["endpoint"],
+    [100, 1000, 10000, 100000, 1000000, 10000000]
+)
+errors = Counter(
+    "http_errors_total",
+    "Number of error responses, by status.",
+    ["status"]
+)
+
+
+def pool_gauge(stat):
+    def collect():
+        stats = pool_stats()
+        if stat not in stats:
+            return {}
+        return {(): stats[stat]}
+    return collect
+
+
+for stat, name, documentation in [
+    ("checkedOut", "db_pool_checked_out",
+     "Number of database connections in use."),
+    ("checkedIn", "db_pool_checked_in",
+     "Number of idle database connections in the pool."),
+    ("overflow", "db_pool_overflow",
+     "Number of database connections over the pool size."),
+    ("size", "db_pool_size", "Size of the database connections pool.")
+]:
+    Gauge(name, documentation, [], function=pool_gauge(stat))
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _beforeCursorExecute(conn, cursor, statement, parameters, context,
+                         executemany):
+    conn.info.setdefault("queryStartTimes", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _afterCursorExecute(conn, cursor, statement, parameters, context,
+                        executemany):
+    queryStartTimes = conn.info.get("queryStartTimes")
+    if not queryStartTimes:
+        return
+    elapsed = time.perf_counter() - queryStartTimes.pop()
+    if has_request_context() and "requestStart" in g:
+        g.dbQueries += 1
+        g.dbDuration += elapsed
+    if slowQueryLog.isSlow(elapsed):
+        slowQueryLog.record(conn, statement, parameters, executemany, elapsed)
+
+
+# statements that fail don't reach `after_cursor_execute`
+@event.listens_for(Engine, "handle_error")
+def _onError(exceptionContext):
+    connection = exceptionContext.connection
+    if connection is not None and connection.info.get("queryStartTimes"):
+        connection.info["queryStartTimes"].pop()
+
+
+"""
+describe_parameters(parameters, executemany)
+    the shape of the bound parameters of a statement, i.e. their names
+    and types without their values, which may be personal data
+"""
+
+
+def describe_value(value):
+    if isinstance(value, (list, tuple)):
+        return "{}[{}]".format(type(value).__name__, len(value))
+    return type(value).__name__
+
+
+def describe_parameters(parameters, executemany):
+    if executemany:
+        if len(parameters) == 0:
+            return "0 rows"
+        return "{} rows of {}".format(
+            len(parameters),
+            describe_parameters(parameters[0], False)
+        )
+    if isinstance(parameters, dict):
+        return ", ".join(
+            "{}: {}".format(name, describe_value(value))
+            for name, value in parameters.items()
+        )
+    # positional parameters, e.g. the ids of a `NOT IN` on SQLite, are
+    # grouped by type
+    groups = []
+    for value in parameters or ():
+        description = describe_value(value)
+        if len(groups) > 0 and groups[-1][0] == description:
+            groups[-1][1] += 1
+        else:
+            groups.append([description, 1])
+    return ", ".join(
+        description if count == 1 else "{} x {}".format(count, description)
+        for description, count in groups
+    )
+
+
+"""
+SlowQueryLog
+    logs the statements slower than `SLOW_QUERY_THRESHOLD_MS`, with the
+    shape of their parameters and their route, and keeps the last ones in
+    a ring buffer; with `SLOW_QUERY_EXPLAIN`, the plans of the slow
+    SELECT statements are captured as well on PostgreSQL, once a minute
+    per statement at most, as capturing them runs them again
+"""
+
+
+class SlowQueryLog:
+    explainInterval = 60
+
+    def __init__(self):
+        self.app = None
+        self.threshold = None
+        self.explain = False
+        self._lock = threading.Lock()
+        self._entries = collections.deque(maxlen=100)
+        self._explainedAt = {}
+
+    def init_app(self, app):
+        self.app = app
+        thresholdMs = app.config["SLOW_QUERY_THRESHOLD_MS"]
+        self.threshold = None if thresholdMs is None else thresholdMs / 1000
+        self.explain = app.config["SLOW_QUERY_EXPLAIN"]
+        with self._lock:
+            self._entries = collections.deque(
+                maxlen=app.config["SLOW_QUERY_LOG_SIZE"]
+            )
+            self._explainedAt = {}
+
+    def isSlow(self, elapsed):
+        return self.threshold is not None and elapsed >= self.threshold
+
+    def record(self, conn, statement, parameters, executemany, elapsed):
+        if conn.info.get("explaining"):
+            return
+        route = None
+        if has_request_context():
+            route = "{} {} ({})".format(
+                request.method,
+                request.path,
+                request.endpoint
+            )
+        entry = {
+            "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "durationMs": round(elapsed * 1000, 3),
+            "parameters": describe_parameters(parameters, executemany),
+            "plan": None,
+            "route": route,
+            "statement": statement
+        }
+        self.app.logger.warning(
+            "slow query (%.3f ms) on %s: %s; parameters: %s",
+            entry["durationMs"],
+            route,
+            statement,
+            entry["parameters"]
+        )
+        if self.shouldExplain(conn, statement, executemany):
+            entry["plan"] = self.explainStatement(conn, statement, parameters)
+        with self._lock:
+            self._entries.append(entry)
+
+    def shouldExplain(self, conn, statement, executemany):
+        if not self.explain or executemany or \
+                conn.dialect.name != "postgresql" or \
+                not statement.lstrip().upper().startswith("SELECT"):
+            return False
+        with self._lock:
+            explainedAt = self._explainedAt.get(statement)
+            if explainedAt is not None and \
+                    time.monotonic() - explainedAt < self.explainInterval:
+                return False
+            self._explainedAt[statement] = time.monotonic()
+        return True
+
+    # runs the statement again on its connection, within a savepoint so
+    # that a failure doesn't abort the transaction of the request
+    def explainStatement(self, conn, statement, parameters):
+        conn.info["explaining"] = True
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(
+                    "EXPLAIN (ANALYZE, BUFFERS) " + statement,
+                    parameters
+                )
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+            except Exception as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                plan = "could not explain the statement: " + str(e)
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        finally:
+            cursor.close()
+            conn.info["explaining"] = False
+
+    def getEntries(self):
+        with self._lock:
+            return list(reversed(self._entries))
+
+
+slowQueryLog = SlowQueryLog()
+
+
+def start_request():
+    requestsInFlight.inc()
+    g.requestStart = time.perf_counter()
+    g.dbQueries = 0
+    g.dbDuration = 0
+
+
+"""
+record_request(app, response)
+    records the figures of the current request and reports them in the
+    `Server-Timing` header of its response
+"""
+
+
+def record_request(app, response):
+    if "requestStart" not in g:
+        return response
+    duration = time.perf_counter() - g.requestStart
+    requestsInFlight.dec()
+    endpoint = request.endpoint or "unmatched"
+    requestDuration.observe(duration, endpoint, str(response.status_code))
+    requestDbQueries.observe(g.dbQueries, endpoint)
+    requestDbDuration.observe(g.dbDuration, endpoint)
+    if not response.is_streamed:
+        responseSize.observe(response.content_length or 0, endpoint)
+    if app.config["SERVER_TIMING"]:
+        response.headers["Server-Timing"] = \
+            'app;dur={:.3f}, db;dur={:.3f};desc="{} queries"'.format(
+                duration * 1000,
+                g.dbDuration * 1000,
+                g.dbQueries
+            )
+    metricsExporter.maybeFlush()
+    return response
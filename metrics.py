@@ -0,0 +1,375 @@
+import atexit
+import bisect
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+"""
+in-process metrics
+
+    metrics are identified by their name and the values of their labels,
+    and are kept by each process; they are registered in `REGISTRY` when
+    they are created
+"""
+
+REGISTRY = []
+
+# durations in seconds, from 1ms to 10s
+DURATION_BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+]
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelNames):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = labelNames
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    # the value of each set of labels values
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+
+"""
+Counter
+    a count that only goes up, e.g. a number of requests
+"""
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labelValues):
+        with self._lock:
+            self._values[labelValues] = self._values.get(labelValues, 0) + 1
+
+
+"""
+Gauge
+    a value that goes up and down, e.g. a number of requests in flight;
+    the values of a gauge with a function are read when it is collected
+"""
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelNames, function=None):
+        super().__init__(name, documentation, labelNames)
+        self.function = function
+
+    def inc(self, *labelValues):
+        with self._lock:
+            self._values[labelValues] = self._values.get(labelValues, 0) + 1
+
+    def dec(self, *labelValues):
+        with self._lock:
+            self._values[labelValues] = self._values.get(labelValues, 0) - 1
+
+    def collect(self):
+        if self.function is not None:
+            return self.function()
+        return super().collect()
+
+
+"""
+Histogram
+    counts the observed values within buckets, along with their sum and
+    count, for each set of labels values; the counts of the buckets are
+    not cumulative until they are rendered
+"""
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelNames, buckets):
+        super().__init__(name, documentation, labelNames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, *labelValues):
+        bucketIndex = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labelValues)
+            if values is None:
+                values = {
+                    "buckets": [0] * (len(self.buckets) + 1),
+                    "sum": 0,
+                    "count": 0
+                }
+                self._values[labelValues] = values
+            values["buckets"][bucketIndex] += 1
+            values["sum"] += value
+            values["count"] += 1
+
+    def collect(self):
+        with self._lock:
+            return {
+                labelValues: dict(values, buckets=list(values["buckets"]))
+                for labelValues, values in self._values.items()
+            }
+
+
+def add_values(metric, total, value):
+    if total is None:
+        return value
+    if metric.type == "histogram":
+        return {
+            "buckets": [a + b for a, b in zip(total["buckets"],
+                                              value["buckets"])],
+            "sum": total["sum"] + value["sum"],
+            "count": total["count"] + value["count"]
+        }
+    return total + value
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+def format_labels(labelNames, labelValues, extraLabels=()):
+    labels = list(zip(labelNames, labelValues)) + list(extraLabels)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, escape_label_value(value))
+        for name, value in labels
+    ) + "}"
+
+
+def format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+"""
+render(collectedValues)
+    the Prometheus text format of the values of each registered metric
+"""
+
+
+def render(collectedValues):
+    lines = []
+    for metric in REGISTRY:
+        lines.append("# HELP {} {}".format(
+            metric.name,
+            metric.documentation
+        ))
+        lines.append("# TYPE {} {}".format(metric.name, metric.type))
+        for labelValues, value in sorted(
+            collectedValues.get(metric.name, {}).items()
+        ):
+            if metric.type != "histogram":
+                lines.append("{}{} {}".format(
+                    metric.name,
+                    format_labels(metric.labelNames, labelValues),
+                    format_number(value)
+                ))
+                continue
+            cumulativeCount = 0
+            for bound, bucketCount in zip(
+                metric.buckets + [float("inf")],
+                value["buckets"]
+            ):
+                cumulativeCount += bucketCount
+                lines.append("{}_bucket{} {}".format(
+                    metric.name,
+                    format_labels(
+                        metric.labelNames,
+                        labelValues,
+                        [("le", format_number(float(bound)))]
+                    ),
+                    cumulativeCount
+                ))
+            for suffix in ["sum", "count"]:
+                lines.append("{}_{}{} {}".format(
+                    metric.name,
+                    suffix,
+                    format_labels(metric.labelNames, labelValues),
+                    format_number(value[suffix])
+                ))
+    return "\n".join(lines) + "\n"
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+"""
+MetricsExporter
+    collects the metrics of the app'; when `METRICS_DIR` is set, each
+    process writes its metrics to a file of that directory at most every
+    `METRICS_FLUSH_INTERVAL` seconds, and the metrics of all the processes
+    are summed when they are collected; the counters and histograms of the
+    processes which have exited are folded into a single aggregate file,
+    and their gauges are dropped, so that recycled workers don't pile up
+    snapshots
+"""
+
+
+class MetricsExporter:
+
+    def __init__(self):
+        self.app = None
+        self.directory = None
+        self.flushInterval = 1
+        self._lock = threading.Lock()
+        self._flushedAt = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.directory = app.config["METRICS_DIR"]
+        self.flushInterval = app.config["METRICS_FLUSH_INTERVAL"]
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def collectLocal(self):
+        with self.app.app_context():
+            return {metric.name: metric.collect() for metric in REGISTRY}
+
+    def snapshotPath(self, pid):
+        return os.path.join(self.directory, "metrics-{}.json".format(pid))
+
+    def aggregatePath(self):
+        return os.path.join(self.directory, "aggregate.json")
+
+    # the pid and path of the snapshot of each process
+    def snapshotPaths(self):
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+            pid = int(os.path.basename(path)[len("metrics-"):-len(".json")])
+            yield pid, path
+
+    def writeSnapshot(self, path, collected):
+        snapshot = {
+            name: [[list(labelValues), value]
+                   for labelValues, value in values.items()]
+            for name, values in collected.items()
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path + ".tmp", "w") as snapshotFile:
+            json.dump(snapshot, snapshotFile)
+        os.replace(path + ".tmp", path)
+
+    # None when the file is missing or being written
+    def readSnapshot(self, path):
+        try:
+            with open(path) as snapshotFile:
+                snapshot = json.load(snapshotFile)
+        except (OSError, ValueError):
+            return None
+        return {
+            name: {tuple(labelValues): value for labelValues, value in values}
+            for name, values in snapshot.items()
+        }
+
+    def flush(self):
+        if not self.directory:
+            return
+        self.writeSnapshot(self.snapshotPath(os.getpid()), self.collectLocal())
+
+    def maybeFlush(self):
+        if not self.directory:
+            return
+        with self._lock:
+            if time.monotonic() - self._flushedAt < self.flushInterval:
+                return
+            self._flushedAt = time.monotonic()
+        self.flush()
+
+    # adds the counters and histograms of the processes which have exited
+    # to the aggregate file, then removes their snapshots; the processes
+    # sharing the directory take turns with a file lock
+    def foldDeadSnapshots(self):
+        if not self.directory:
+            return
+        metrics = {metric.name: metric for metric in REGISTRY}
+        os.makedirs(self.directory, exist_ok=True)
+        lockPath = os.path.join(self.directory, "aggregate.lock")
+        with open(lockPath, "w") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            deadPaths = [
+                path for pid, path in self.snapshotPaths()
+                if pid != os.getpid() and not is_process_alive(pid)
+            ]
+            if len(deadPaths) == 0:
+                return
+            aggregate = self.readSnapshot(self.aggregatePath()) or {}
+            for path in deadPaths:
+                for name, values in (self.readSnapshot(path) or {}).items():
+                    metric = metrics.get(name)
+                    if metric is None or metric.type == "gauge":
+                        continue
+                    totals = aggregate.setdefault(name, {})
+                    for labelValues, value in values.items():
+                        totals[labelValues] = add_values(
+                            metric,
+                            totals.get(labelValues),
+                            value
+                        )
+            self.writeSnapshot(self.aggregatePath(), aggregate)
+            for path in deadPaths:
+                os.remove(path)
+
+    def collect(self):
+        collected = self.collectLocal()
+        if not self.directory:
+            return collected
+        self.foldDeadSnapshots()
+        metrics = {metric.name: metric for metric in REGISTRY}
+        paths = [
+            (path, is_process_alive(pid))
+            for pid, path in self.snapshotPaths() if pid != os.getpid()
+        ]
+        # the aggregate file holds no gauges
+        for path, isAlive in paths + [(self.aggregatePath(), True)]:
+            snapshot = self.readSnapshot(path)
+            if snapshot is None:
+                continue
+            for name, values in snapshot.items():
+                metric = metrics.get(name)
+                if metric is None or metric.type == "gauge" and not isAlive:
+                    continue
+                for labelValues, value in values.items():
+                    collected[name][labelValues] = add_values(
+                        metric,
+                        collected[name].get(labelValues),
+                        value
+                    )
+        return collected
+
+    def render(self):
+        return render(self.collect())
+
+
+metricsExporter = MetricsExporter()
+
+
+# the last figures of a process are written when it exits
+@atexit.register
+def _flushOnExit():
+    if metricsExporter.app is not None:
+        metricsExporter.flush()
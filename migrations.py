@@ -0,0 +1,224 @@
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    inspect,
+    select,
+    text
+)
+
+from models import db
+
+"""
+versioned migrations of the database schema
+
+    each step runs once, in order, within the same transaction as the
+    record of its version in the `schema_version` table; they are applied
+    with `flask db upgrade`, so that booting the app' runs no DDL
+"""
+
+schemaVersionTable = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False, server_default=func.now())
+)
+
+
+# the DDL of the steps is written out, so that a version always means the
+# same schema whatever the models become; the tables of the databases
+# seeded by `docker/sql/rest.psql` already exist
+def create_tables(connection):
+    if connection.dialect.name == "postgresql":
+        idType = "SERIAL"
+    else:
+        idType = "INTEGER"
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS categories ("
+        "id " + idType + " NOT NULL, "
+        "type VARCHAR NOT NULL, "
+        "PRIMARY KEY (id), "
+        "UNIQUE (type))"
+    ))
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS items ("
+        "id " + idType + " NOT NULL, "
+        "item VARCHAR NOT NULL, "
+        "category INTEGER NOT NULL, "
+        "PRIMARY KEY (id), "
+        "UNIQUE (item), "
+        "FOREIGN KEY (category) REFERENCES categories (id) "
+        "ON DELETE CASCADE)"
+    ))
+
+
+def create_items_category_index(connection):
+    # the tables of databases created before this index was added
+    # already exist, so `create_tables` does not create it for them
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_items_category_id "
+        "ON items (category, id)"
+    ))
+
+
+# a trigram index on the items titles, so that `%term%` searches
+# don't need a sequential scan of the items table
+def create_items_search_index(connection):
+    if connection.dialect.name != "postgresql":
+        return
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_items_item_trgm "
+        "ON items USING gin (item gin_trgm_ops)"
+    ))
+
+
+# the items version is bumped once per statement on PostgreSQL, and once
+# per row on SQLite, which has no statement triggers
+def create_items_version(connection):
+    connection.execute(text(
+        "CREATE TABLE data_versions ("
+        "name VARCHAR PRIMARY KEY, "
+        "version BIGINT NOT NULL)"
+    ))
+    connection.execute(text(
+        "INSERT INTO data_versions (name, version) VALUES ('items', 0)"
+    ))
+    bumpItemsVersion = \
+        "UPDATE data_versions SET version = version + 1 WHERE name = 'items'"
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(
+            "CREATE FUNCTION bump_items_version() RETURNS trigger AS $$ "
+            "BEGIN " + bumpItemsVersion + "; RETURN NULL; END; "
+            "$$ LANGUAGE plpgsql"
+        ))
+        connection.execute(text(
+            "CREATE TRIGGER items_version "
+            "AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON items "
+            "FOR EACH STATEMENT EXECUTE PROCEDURE bump_items_version()"
+        ))
+        return
+    for operation in ["INSERT", "UPDATE", "DELETE"]:
+        connection.execute(text(
+            "CREATE TRIGGER items_version_" + operation.lower() + " "
+            "AFTER " + operation + " ON items "
+            "BEGIN " + bumpItemsVersion + "; END"
+        ))
+
+
+MIGRATIONS = [
+    (1, "create the tables", create_tables),
+    (2, "index the items by category", create_items_category_index),
+    (3, "index the items titles for searches", create_items_search_index),
+    (4, "version the items", create_items_version)
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+"""
+schema_version(connection)
+    the version of the schema of a database, 0 when it has never been
+    migrated
+"""
+
+
+def schema_version(connection):
+    if not inspect(connection).has_table(schemaVersionTable.name):
+        return 0
+    return connection.execute(
+        select(func.max(schemaVersionTable.c.version))
+    ).scalar() or 0
+
+
+"""
+upgrade(engine)
+    applies the pending migrations to a database and returns the
+    descriptions of the applied ones; a failing step rolls the whole
+    upgrade back, so that no version is recorded without its changes
+"""
+
+
+def upgrade(engine):
+    applied = []
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # building indexes on big tables outlasts the statement
+            # timeout of the requests
+            connection.execute(text("SET LOCAL statement_timeout = 0"))
+        schemaVersionTable.create(connection, checkfirst=True)
+        if connection.dialect.name == "postgresql":
+            # concurrent upgrades wait for each other
+            connection.execute(text(
+                "LOCK TABLE schema_version IN EXCLUSIVE MODE"
+            ))
+        currentVersion = schema_version(connection)
+        for version, description, step in MIGRATIONS:
+            if version <= currentVersion:
+                continue
+            step(connection)
+            connection.execute(schemaVersionTable.insert().values(
+                version=version,
+                description=description
+            ))
+            applied.append(description)
+    return applied
+
+
+"""
+check_schema(app)
+    fails the boot of an app' whose database has pending migrations
+"""
+
+
+def check_schema(app):
+    with app.app_context(), db.engine.connect() as connection:
+        currentVersion = schema_version(connection)
+    if currentVersion < LATEST_VERSION:
+        raise RuntimeError(
+            "the database schema is at version {} instead of {}, "
+            "please run `flask db upgrade`".format(
+                currentVersion,
+                LATEST_VERSION
+            )
+        )
+
+
+dbCli = AppGroup("db", help="Manage the database schema.")
+
+
+# streaming replicas get the migrations of the primary, but the stand-ins
+# which don't replicate it have to be migrated on their own
+@dbCli.command("upgrade")
+@click.option(
+    "--replicas",
+    is_flag=True,
+    help="Also migrate the read replicas, when they are not replicated."
+)
+def upgrade_command(replicas):
+    """Apply the pending migrations."""
+    binds = [None]
+    if replicas:
+        binds += current_app.config.get("REPLICA_BINDS", [])
+    for bind in binds:
+        for description in upgrade(db.get_engine(bind=bind)):
+            click.echo("applied{}: {}".format(
+                "" if bind is None else " on " + bind,
+                description
+            ))
+    click.echo("schema at version " + str(LATEST_VERSION))
+
+
+@dbCli.command("version")
+def version_command():
+    """Show the version of the schema."""
+    with db.engine.connect() as connection:
+        click.echo(str(schema_version(connection)))
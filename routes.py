@@ -1,9 +1,17 @@
 from unicodedata import category
-from flask import abort, jsonify, request
-from helpers import paginate_items
+from flask import abort, g, jsonify, request, stream_with_context
+import json
+from cache import cached_response, categoriesCache, conditional_response, \
+    dataVersion, itemCountsCache, items_namespace, seenItemsStore
+from helpers import EXPORT_CONTENT_TYPES, app_item_args, export_chunks, \
+    get_list_arg, is_ids_list, items_count_query, items_list_args, \
+    items_list_data, items_list_query, items_page_query, needs_items_count, \
+    split_page
 import sys
+import time
 
-from models import Category, Item, db
+from models import Item, db, delete_category_items, delete_items, \
+    insert_item, insert_items, pick_unseen_item, read_only, search_items
 
 
 def init_routes(app):
@@ -16,21 +24,55 @@ def init_routes(app):
             except KeyError as k:
                 abort(400)
 
+    # the type of a category id; the categories cache is reloaded once per
+    # request on a miss, as another worker may have created the category
+    # since it was loaded
+    def getCategType(categId):
+        categType = categoriesCache.getTypeById(categId)
+        if categType is None and not g.get("categoriesReloaded"):
+            g.categoriesReloaded = True
+            categoriesCache.invalidate()
+            categType = categoriesCache.getTypeById(categId)
+        return categType
+
+    # items without their category nor the categories list don't change
+    # with the categories
+    def itemsVersion():
+        listArgs = items_list_args(request.args)
+        fields = listArgs["fields"]
+        if listArgs["includesCategories"] or fields is None or \
+                "category" in fields:
+            return dataVersion.items()
+        return str(dataVersion.itemsVersion())
+
     @app.route("/api/items", methods=["POST"])
     def create_item():
         error = False
+        created = False
+        formattedItem = None
         abort400IfNoField(["item", "category"])
+        conflictMode = request.get_json().get("onConflict", "reject")
+        if conflictMode not in ["reject", "ignore", "returnExisting"]:
+            abort(400)
+        title = request.get_json()["item"]
+        categId = request.get_json()["category"]
+        if isinstance(categId, str) and categId.isdigit():
+            categId = int(categId)
         try:
-            item = Item(
-                item=request.get_json()["item"],
-                category=request.get_json()["category"]
-            )
-            if not item.checkItemUniqueness():
-                error = True
-            else:
-                db.session.add(item)
+            itemId = insert_item(title, categId)
+            if itemId is not None:
                 db.session.commit()
-                formattedItem = item.format()
+                created = True
+                # the inserted row is known, only its category type is read
+                formattedItem = Item.formatRow(
+                    (itemId, title, getCategType(categId))
+                )
+            elif conflictMode == "reject":
+                error = True
+            elif conflictMode == "returnExisting":
+                formattedItem = Item.formatRow(
+                    Item.queryRows().filter(Item.item == title).one()
+                )
         except Exception as e:
             error = True
             print(sys.exc_info())
@@ -39,22 +81,125 @@ def init_routes(app):
             db.session.close()
             if error:
                 abort(422)
-            else:
+            elif created:
+                dataVersion.recordItemsWrite(categId)
                 return jsonify({
                     "msg": "item created",
                     "success": True,
                     "data": formattedItem
                 }), 201
+            else:
+                return jsonify({
+                    "msg": "item already exists",
+                    "success": True,
+                    "data": formattedItem
+                }), 200
+
+    # the rows of a bulk request, from a JSON array or an NDJSON stream
+    def getBulkRows():
+        if request.mimetype == "application/x-ndjson":
+            return iterNdjsonRows()
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list) or len(rows) == 0:
+            abort(400)
+        return rows
+
+    def iterNdjsonRows():
+        for line in request.stream:
+            if line.strip() == b'':
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+    # returns the row to insert for a bulk request row, None if invalid
+    def getValidBulkRow(row):
+        if not isinstance(row, dict):
+            return None
+        title = row.get("item")
+        categId = row.get("category")
+        if isinstance(categId, str) and categId.isdigit():
+            categId = int(categId)
+        if not isinstance(title, str) or title == '' or \
+                not isinstance(categId, int) or isinstance(categId, bool) or \
+                getCategType(categId) is None:
+            return None
+        return {"item": title, "category": categId}
+
+    @app.route("/api/items/bulk", methods=["POST"])
+    def create_items():
+        error = False
+        startedAt = time.perf_counter()
+        rows = getBulkRows()
+        results = []
+        seenTitles = set()
+        createdCategIds = set()
+        batch = []
+
+        def insertBatch():
+            insertedIds = insert_items([row for row, result in batch])
+            for row, result in batch:
+                if row["item"] in insertedIds:
+                    result["status"] = "created"
+                    result["id"] = insertedIds[row["item"]]
+                    createdCategIds.add(row["category"])
+                else:
+                    result["status"] = "duplicate"
+            batch.clear()
+
+        try:
+            for row in rows:
+                result = {"index": len(results), "status": None, "id": None}
+                results.append(result)
+                validRow = getValidBulkRow(row)
+                if validRow is None:
+                    result["status"] = "invalid"
+                elif validRow["item"] in seenTitles:
+                    result["status"] = "duplicate"
+                else:
+                    seenTitles.add(validRow["item"])
+                    batch.append((validRow, result))
+                    if len(batch) == app.config["BULK_INSERT_BATCH_SIZE"]:
+                        insertBatch()
+            insertBatch()
+            db.session.commit()
+        except Exception as e:
+            error = True
+            print(sys.exc_info())
+            db.session.rollback()
+        finally:
+            db.session.close()
+            if error:
+                abort(422)
+            else:
+                if len(createdCategIds) > 0:
+                    dataVersion.recordItemsWrite(*createdCategIds)
+                elapsed = time.perf_counter() - startedAt
+                statuses = [result["status"] for result in results]
+                return jsonify({
+                    "msg": "items imported",
+                    "success": True,
+                    "data": {
+                        "created": statuses.count("created"),
+                        "duplicates": statuses.count("duplicate"),
+                        "invalid": statuses.count("invalid"),
+                        "elapsedMs": round(elapsed * 1000, 3),
+                        "itemsPerSecond": round(
+                            statuses.count("created") / elapsed, 3
+                        ),
+                        "results": results
+                    }
+                }), 200
 
     @app.route('/api/items/<item_id>', methods=['DELETE'])
     def delete_item(item_id):
         error = False
         try:
-            item = Item.query.filter_by(id=item_id).first()
-            if item is None:
+            deletedCategIds = delete_items(Item.id == int(item_id))
+            if len(deletedCategIds) == 0:
                 error = True
             else:
-                Item.query.filter_by(id=item_id).delete()
                 db.session.commit()
         except Exception as e:
             error = True
@@ -65,10 +210,65 @@ def init_routes(app):
             if error:
                 abort(422)
             else:
+                dataVersion.recordItemsWrite(*deletedCategIds)
                 # a no content response is not supposed to have a body
                 return '', 204
 
+    @app.route('/api/items', methods=['DELETE'])
+    def delete_items_batch():
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict) or \
+                ("ids" in payload) == ("category" in payload):
+            abort(400)
+        categId = None
+        if "ids" in payload:
+            if not is_ids_list(payload["ids"]):
+                abort(400)
+        else:
+            if not isinstance(payload["category"], str):
+                abort(400)
+            categId = categoriesCache.getIdByType(payload["category"])
+            if categId is None:
+                abort(404)
+        error = False
+        batchSize = app.config["BULK_DELETE_BATCH_SIZE"]
+        deletedCount = 0
+        try:
+            if categId is None:
+                ids = sorted(set(payload["ids"]))
+                deletedCategIds = set()
+                for start in range(0, len(ids), batchSize):
+                    batchCategIds = delete_items(
+                        Item.id.in_(ids[start:start + batchSize])
+                    )
+                    deletedCount += len(batchCategIds)
+                    deletedCategIds.update(batchCategIds)
+            else:
+                deletedCount = delete_category_items(categId, batchSize)
+                deletedCategIds = {categId}
+            db.session.commit()
+        except Exception as e:
+            error = True
+            db.session.rollback()
+            print(str(e))
+        finally:
+            db.session.close()
+            if error:
+                abort(422)
+            else:
+                if deletedCount > 0:
+                    dataVersion.recordItemsWrite(*deletedCategIds)
+                return jsonify({
+                    "msg": "items deleted",
+                    "success": True,
+                    "data": {
+                        "deleted": deletedCount
+                    }
+                }), 200
+
     @app.route("/api", methods=["GET"])
+    @read_only
+    @conditional_response(lambda: "up")
     def get_base_url():
         return jsonify({
             "msg": "REST API is up",
@@ -76,14 +276,37 @@ def init_routes(app):
             "data": None
         }), 200
 
+    def includesItemCount():
+        return "itemCount" in (
+            get_list_arg(request.args, "include", ["itemCount"]) or []
+        )
+
+    # categories with their items counts change with the items
+    def categoriesVersion():
+        if includesItemCount():
+            return dataVersion.items()
+        return dataVersion.categories()
+
+    def categoriesNamespaces():
+        if includesItemCount():
+            return ["categories", "items:all"]
+        return ["categories"]
+
     @app.route("/api/categories", methods=["GET"])
+    @read_only
+    @conditional_response(categoriesVersion)
+    @cached_response(categoriesNamespaces)
     def get_categories():
-        categories = []
-        categories = Category.query.order_by(Category.id).all()
-        formattedCategs = [category.format() for category in categories]
+        formattedCategs = categoriesCache.getFormattedCategories()
         if (len(formattedCategs) == 0):
             abort(404)
         else:
+            if includesItemCount():
+                itemCounts = itemCountsCache.getItemCounts()
+                formattedCategs = [
+                    dict(categ, itemCount=itemCounts.get(categ["id"], 0))
+                    for categ in formattedCategs
+                ]
             return jsonify({
                 "msg": "fetched categories",
                 "success": True,
@@ -93,75 +316,110 @@ def init_routes(app):
                 }
             }), 200
 
-    @app.route("/api/items", methods=["GET"])
-    def get_items():
-        items = None
+    @app.route("/api/items/export", methods=["GET"])
+    @read_only
+    def export_items():
+        exportFormat = request.args.get("format", "ndjson", type=str)
+        if exportFormat not in EXPORT_CONTENT_TYPES:
+            abort(400)
         requestedCategStr = request.args.get("categ", '', type=str)
         requestedSearchTermStr = request.args.get("searchTerm", '', type=str)
-        if requestedCategStr == '':
-            items = Item.query.order_by(
-                Item.id
-            ).filter(Item.item.ilike(
-                '%'+requestedSearchTermStr+'%'
-            )).all()
-        else:
-            requestedCateg = Category.query.filter_by(
-                type=requestedCategStr
-            ).first()
-            if requestedCateg is None:
+        itemsQuery = Item.queryRows().order_by(Item.id)
+        if requestedCategStr != '':
+            requestedCategId = categoriesCache.getIdByType(requestedCategStr)
+            if requestedCategId is None:
                 abort(404)
-            items = Item.query.filter_by(
-                category=requestedCateg.id
-            ).order_by(
-                Item.id
-            ).filter(Item.item.ilike(
-                '%'+requestedSearchTermStr+'%'
-            )).all()
-        formattedItems = [item.format() for item in items]
-        categories = Category.query.order_by(Category.id).all()
-        paginatedItems = paginate_items(
-            app.config["ITEMS_BATCH_SIZE"],
-            request.args.get("page", 1, type=int),
-            formattedItems
+            itemsQuery = itemsQuery.filter(
+                Item.category == requestedCategId
+            )
+        itemsQuery = search_items(itemsQuery, requestedSearchTermStr)
+        # rows are fetched batch by batch from a server side cursor,
+        # so that the memory used does not depend on the number of items
+        batchSize = app.config["EXPORT_BATCH_SIZE"]
+        rows = itemsQuery.yield_per(batchSize)
+        response = app.response_class(
+            stream_with_context(export_chunks(rows, exportFormat, batchSize)),
+            status=200,
+            content_type=EXPORT_CONTENT_TYPES[exportFormat]
+        )
+        response.headers["Content-Disposition"] = \
+            "attachment; filename=items." + exportFormat
+        return response
+
+    @app.route("/api/items", methods=["GET"])
+    @read_only
+    @conditional_response(itemsVersion)
+    @cached_response(lambda: [
+        "categories",
+        items_namespace(request.args.get("categ", '', type=str))
+    ])
+    def get_items():
+        listArgs = items_list_args(request.args)
+        batchSize = app.config["ITEMS_BATCH_SIZE"]
+        categId = None
+        if listArgs["categ"] != '':
+            categId = categoriesCache.getIdByType(listArgs["categ"])
+            if categId is None:
+                abort(404)
+        itemsQuery = items_list_query(
+            listArgs,
+            categId,
+            db.engine.dialect.name
+        )
+        paginatedItems, hasMore = split_page(
+            db.session.execute(
+                items_page_query(itemsQuery, listArgs, batchSize)
+            ).all(),
+            batchSize
         )
-        formattedCategs = [category.format() for category in categories]
         if (len(paginatedItems) == 0):
             abort(404)
-        else:
-            return jsonify({
-                "msg": "fetched items",
-                "success": True,
-                "data": {
-                    "categories": formattedCategs,
-                    "currentCategory": requestedCategStr,
-                    "items": paginatedItems,
-                    "totalItems": len(formattedItems)
-                }
-            }), 200
+        totalItems = None
+        if needs_items_count(listArgs, hasMore):
+            totalItems = db.session.execute(
+                items_count_query(itemsQuery)
+            ).scalar()
+        data = items_list_data(
+            listArgs,
+            batchSize,
+            paginatedItems,
+            hasMore,
+            totalItems
+        )
+        if listArgs["includesCategories"]:
+            data["categories"] = categoriesCache.getFormattedCategories()
+        return jsonify({
+            "msg": "fetched items",
+            "success": True,
+            "data": data
+        }), 200
 
     @app.route("/api/stuff", methods=["POST"])
+    @read_only
     def get_app_item():
-        abort400IfNoField(["prevItems", "category"])
-        requestCateg = request.get_json()["category"]
-        item = None
-        if requestCateg == "all":
-            item = db.session.query(Item).filter(
-                Item.id.not_in(request.get_json()["prevItems"])
-            ).first()
-        else:
-            categ = Category.query.filter_by(
-                type=requestCateg
-            ).first()
-            if categ is None:
+        appItemArgs = app_item_args(request.get_json(silent=True))
+        usesSession = appItemArgs["usesSession"]
+        seenIds = appItemArgs["prevItems"]
+        sessionToken = appItemArgs["sessionToken"]
+        if usesSession:
+            if sessionToken is None:
+                sessionToken = seenItemsStore.newToken()
+            else:
+                seenIds |= seenItemsStore.getSeen(sessionToken)
+        categId = None
+        if appItemArgs["category"] != "all":
+            categId = categoriesCache.getIdByType(appItemArgs["category"])
+            if categId is None:
                 abort(404)
-            item = db.session.query(Item).filter(
-                Item.category == categ.id,
-                Item.id.not_in(request.get_json()["prevItems"])
-            ).first()
+        item = pick_unseen_item(categId, seenIds)
         if item is None:
             abort(400)
+        formattedItem = Item.formatRow(item)
+        if usesSession:
+            seenItemsStore.addSeen(sessionToken, item.id)
+            formattedItem["sessionToken"] = sessionToken
         return jsonify({
             "msg": "app item fetched",
             "success": True,
-            "data": item.format()
+            "data": formattedItem
         }), 200
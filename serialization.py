@@ -0,0 +1,142 @@
+import json
+import re
+import secrets
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+RawJSON(value)
+    an already serialized JSON value, as bytes, inserted as is in the
+    responses, e.g. lists of rows serialized without building a dict per
+    row first
+"""
+
+
+class RawJSON:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+DIGITS_AS_ZEROS = bytes.maketrans(b"123456789", b"000000000")
+
+
+# floats whose orjson output may differ from the stdlib one, which writes
+# `1e-05` and `1e+16` where orjson writes `0.00001` and `1e16`; a digit
+# followed by `e` can also be part of a string, which is only slower
+def has_orjson_float_forms(body):
+    return b"0.0000" in body or b"0e" in body.translate(DIGITS_AS_ZEROS)
+
+
+NON_ASCII_CHARS = re.compile("[\x7f-\U0010ffff]")
+
+
+def escape_non_ascii(body):
+    return NON_ASCII_CHARS.sub(
+        lambda match: json.encoder.encode_basestring_ascii(
+            match.group()
+        )[1:-1],
+        body.decode()
+    ).encode()
+
+
+"""
+dumps_compact(obj, default=None, sortKeys=True, ensureAscii=True)
+    serializes an object to compact JSON bytes, with orjson when it is
+    installed and with the stdlib otherwise; both write the same bytes,
+    orjson payloads that could differ are serialized again by the stdlib
+"""
+
+
+def dumps_compact(obj, default=None, sortKeys=True, ensureAscii=True):
+    rawValues = []
+    token = None
+
+    def encodeOther(o):
+        nonlocal token
+        if isinstance(o, RawJSON):
+            if token is None:
+                token = secrets.token_hex(8)
+            rawValues.append(o.value)
+            return "rawjson:{}:{}".format(token, len(rawValues) - 1)
+        if default is None:
+            raise TypeError(
+                "Object of type {} is not JSON serializable".format(
+                    type(o).__name__
+                )
+            )
+        return default(o)
+
+    body = None
+    if orjson is not None:
+        option = orjson.OPT_PASSTHROUGH_DATACLASS | \
+            orjson.OPT_PASSTHROUGH_DATETIME
+        if sortKeys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            body = orjson.dumps(obj, default=encodeOther, option=option)
+        except TypeError:
+            # e.g. non string keys or integers over 64 bits
+            body = None
+        if body is not None and has_orjson_float_forms(body):
+            body = None
+        if body is None:
+            rawValues.clear()
+        elif ensureAscii and (not body.isascii() or b"\x7f" in body):
+            body = escape_non_ascii(body)
+    if body is None:
+        body = json.dumps(
+            obj,
+            default=encodeOther,
+            ensure_ascii=ensureAscii,
+            sort_keys=sortKeys,
+            separators=(",", ":")
+        ).encode()
+    for i, value in enumerate(rawValues):
+        body = body.replace(
+            '"rawjson:{}:{}"'.format(token, i).encode(),
+            value,
+            1
+        )
+    return body
+
+
+"""
+FastJSONProvider
+    JSON provider of the app', writing the same responses as Flask's
+    default provider, faster; the pretty printed responses of debug mode
+    are still written by the default provider
+"""
+
+
+class FastJSONProvider(DefaultJSONProvider):
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, RawJSON):
+            return json.loads(o.value)
+        return DefaultJSONProvider.default(o)
+
+    def dumpsCompact(self, obj):
+        return dumps_compact(
+            obj,
+            default=DefaultJSONProvider.default,
+            sortKeys=self.sort_keys,
+            ensureAscii=self.ensure_ascii
+        )
+
+    def response(self, *args, **kwargs):
+        if self.compact is False or \
+                (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            self.dumpsCompact(obj) + b"\n",
+            mimetype=self.mimetype
+        )
@@ -0,0 +1,12 @@
+from flaskr import create_app
+from migrations import check_schema
+
+"""
+entry point of the production servers, e.g.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+app = create_app()
+if app.config["DB_CHECK_SCHEMA"]:
+    check_schema(app)